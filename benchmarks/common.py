@@ -0,0 +1,113 @@
+"""Helpers shared by the peyecoder benchmarks: timing, summary statistics, memory use and JSON results"""
+
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows
+
+from peyecoder import version
+
+PERCENTILES = (50, 90, 99)
+
+
+def summarize(samples):
+    """Summarize a list of durations (in seconds) as milliseconds: count, mean, percentiles and maximum"""
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    summary = {'count': len(samples), 'mean_ms': sum(samples) / len(samples) * 1000}
+    for p in PERCENTILES:
+        # nearest-rank percentile
+        index = min(len(samples) - 1, max(0, -(-p * len(samples) // 100) - 1))
+        summary['p{}_ms'.format(p)] = samples[index] * 1000
+    summary['max_ms'] = samples[-1] * 1000
+    return summary
+
+
+def time_calls(func, args_list):
+    """Call func once for each tuple of arguments, returning the duration of each call in seconds"""
+    durations = []
+    for args in args_list:
+        t0 = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - t0)
+    return durations
+
+
+def best_of(func, repeat=5, setup=None):
+    """Run func several times and return the shortest duration in seconds, which is the least affected by
+    other activity on the computer
+    :param setup: If given, called (untimed) before each run, e.g. to discard cached values
+    """
+    best = None
+    for i in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        duration = time.perf_counter() - t0
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in bytes, or None if it can't be determined"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def environment():
+    """Describe the software and hardware used to run a benchmark, so results from different computers are
+    not compared by mistake
+    """
+    env = {
+        'peyecoder': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+    for module in ('numpy', 'cv2', 'sortedcontainers', 'PySide2'):
+        try:
+            env[module] = __import__(module).__version__
+        except (ImportError, AttributeError):
+            env[module] = None
+    return env
+
+
+def write_results(filename, name, results, parameters):
+    """Save benchmark results as JSON, along with the parameters and environment used to produce them
+    :param filename: Output filename, or '-' for standard output
+    :param name: Name of the benchmark
+    :param results: JSON-serializable results
+    :param parameters: Parameters of the benchmark (e.g., command line options)
+    """
+    data = {
+        'benchmark': name,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'parameters': parameters,
+        'results': results,
+    }
+    text = json.dumps(data, indent=2)
+    if filename == '-':
+        print(text)
+    else:
+        with open(filename, 'w') as f:
+            f.write(text + '\n')
+
+
+def read_results(filename):
+    with open(filename) as f:
+        return json.load(f)
@@ -0,0 +1,94 @@
+"""Compare benchmark results with a baseline, failing if anything has become slower
+
+Timings (values ending in _ms) which are more than --threshold times the baseline, and by more than
+--min-difference milliseconds, are reported as regressions, as are complexity slopes (see data_bench) which have
+grown by more than --slope-tolerance.  The exit status is 1 if there are any regressions, so the script can be
+used as a gate before a release.
+
+Example:
+    python -m benchmarks.data_bench --output current.json
+    python -m benchmarks.compare baseline.json current.json
+"""
+
+import argparse
+import sys
+
+from benchmarks.common import read_results
+
+
+def flatten(data, prefix=''):
+    """Flatten nested dicts and lists of results to {'path.to.value': number}"""
+    values = {}
+    if isinstance(data, dict):
+        items = data.items()
+    elif isinstance(data, list):
+        items = enumerate(data)
+    else:
+        if isinstance(data, (int, float)) and not isinstance(data, bool):
+            values[prefix] = data
+        return values
+    for key, value in items:
+        values.update(flatten(value, '{}.{}'.format(prefix, key) if prefix else str(key)))
+    return values
+
+
+def compare(baseline, current, threshold=1.25, min_difference=0.1, slope_tolerance=0.2):
+    """Compare two sets of benchmark results
+    :return: list of (metric, baseline value, current value, regression?) for the metrics in both sets
+    """
+    baseline_values = flatten(baseline['results'])
+    current_values = flatten(current['results'])
+    comparisons = []
+    for metric, old in baseline_values.items():
+        new = current_values.get(metric)
+        if new is None:
+            continue
+        # the name of the value, ignoring list indices (e.g., time_ms for operations.render.time_ms.3)
+        name = next(key for key in reversed(metric.split('.')) if not key.isdigit())
+        if name.endswith('_ms'):
+            regression = new > old * threshold and new - old > min_difference
+        elif name == 'slope':
+            regression = new > old + slope_tolerance
+        else:
+            continue
+        comparisons.append((metric, old, new, regression))
+    return comparisons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.compare', description=__doc__.split('\n')[0])
+    parser.add_argument('baseline', help='JSON results of the baseline')
+    parser.add_argument('current', help='JSON results to check')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='ratio to the baseline above which a timing is a regression (default: %(default)s)')
+    parser.add_argument('--min-difference', type=float, default=0.1,
+                        help='ignore timings which differ by fewer milliseconds (default: %(default)s)')
+    parser.add_argument('--slope-tolerance', type=float, default=0.2,
+                        help='allowed increase in complexity slopes (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='list all metrics, not just regressions')
+    args = parser.parse_args(argv)
+
+    baseline = read_results(args.baseline)
+    current = read_results(args.current)
+    if baseline['benchmark'] != current['benchmark']:
+        parser.error('cannot compare results of different benchmarks ({} and {})'.format(
+            baseline['benchmark'], current['benchmark']))
+    for key in sorted(set(baseline['parameters']) | set(current['parameters'])):
+        if key != 'output' and baseline['parameters'].get(key) != current['parameters'].get(key):
+            print('Warning: parameter {} differs ({} and {})'.format(
+                key, baseline['parameters'].get(key), current['parameters'].get(key)), file=sys.stderr)
+    if baseline['environment'] != current['environment']:
+        print('Warning: results are from different environments', file=sys.stderr)
+
+    comparisons = compare(baseline, current, args.threshold, args.min_difference, args.slope_tolerance)
+    regressions = [c for c in comparisons if c[3]]
+    for metric, old, new, regression in comparisons:
+        if regression or args.verbose:
+            print('{:50} {:>12.3f} {:>12.3f} {:>7.2f}x{}'.format(
+                metric, old, new, new / old if old else float('inf'), '  REGRESSION' if regression else ''))
+    print('{} of {} metrics regressed'.format(len(regressions), len(comparisons)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""Benchmark the data layer: validation, rendering the code log, exports, reliability and data files
+
+Synthetic subjects are generated at several sizes (numbers of trials), and each operation is timed at each size.
+The growth of each operation with the number of events is summarized as the slope of log(time) against
+log(events): about 1 for operations which take linear time, 2 for quadratic time.
+
+Example:
+    python -m benchmarks.data_bench --sizes 25,50,100,200,400 --output data.json
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import timecode
+
+from benchmarks.common import best_of, peak_memory, write_results
+from peyecoder.export import export_long, export_wide, INVERT_TRIAL_ORDER
+from peyecoder.file_utils import save_datafile
+from peyecoder.models import Subject, Event, Reason, Trial, TrialOrder, Offsets
+from peyecoder.reliability import reliability_report
+
+RESPONSES = ('left', 'right', 'center', 'away', 'off')
+
+
+def make_subject(trials, events_per_trial=10, offsets=1, frames_per_event=20, seed=0):
+    """Generate a subject with a trial order, coded events, pre-screening reasons and timecode offsets
+    :param trials: Number of trials
+    :param events_per_trial: Number of events coded for each trial (including the event ending the trial)
+    :param offsets: Number of timecode offsets (e.g., where the timecode was resynchronized)
+    :param frames_per_event: Mean number of frames between events
+    :param seed: Random seed
+    """
+    rnd = random.Random(seed)
+    s = Subject()
+    s.update_from_dict({'Number': '101', 'Birthday': '01/02/2019', 'Date of Test': '03/04/2020', 'Sex': True,
+                        'Coder': 'benchmark'})
+    s.set_framerate(29.97)
+    s.trial_order = TrialOrder([Trial({'Name': 'Order1', 'Trial Number': t, 'Sound Stimulus': 'sound',
+                                       'Left Image': 'left{}'.format(t), 'Center Image': 'center',
+                                       'Right Image': 'right{}'.format(t), 'Target Side': rnd.choice('LR'),
+                                       'Condition': 'condition', 'Used': 'yes' if t % 10 else 'no',
+                                       'Trial End': 6000, 'Critical Onset': rnd.randint(1000, 3000)})
+                                for t in range(1, trials + 1)])
+    frame = 0
+    for t in range(1, trials + 1):
+        frame += rnd.randint(1, 2 * frames_per_event)
+        for i in range(events_per_trial):
+            last = i == events_per_trial - 1
+            s.events.add_event(Event(t, not last, 'off' if last else rnd.choice(RESPONSES), frame))
+            frame += rnd.randint(1, 2 * frames_per_event)
+        if t % 7 == 0:
+            s.reasons.add_reason(Reason(t, False, 'Inattentive'), 1)
+    s.timecode_offsets = Offsets({frame * i // offsets: 100 * i for i in range(offsets)})
+    return s
+
+
+def second_coding(s, seed=0):
+    """Copy the events of a subject as a second coder might code them: shifting some events by a few frames,
+    changing some responses and omitting some events, so that some trials have different numbers of events
+    """
+    rnd = random.Random(seed)
+    s2 = make_subject(0)
+    s2.trial_order = s.trial_order
+    s2.set_framerate(s['Framerate'])
+    for trial, events in s.events.trials().items():
+        for i, e in enumerate(events):
+            if 0 < i < len(events) - 1 and rnd.random() < 0.05:
+                continue
+            response = rnd.choice(RESPONSES[:3]) if e.status == 'on' and rnd.random() < 0.05 else e.response
+            s2.events.add_event(Event(e.trial, e.status == 'on', response, max(0, e.frame + rnd.randint(-2, 2))))
+    return s2
+
+
+def bench_size(trials, args, tmpdir):
+    """Time each operation for a subject with the given number of trials, returning {operation: seconds}"""
+    s = make_subject(trials, args.events, args.offsets, args.frames_per_event, args.seed)
+    s2 = second_coding(s, args.seed)
+    tc = timecode.Timecode('29.97')
+    tc.drop_frame = False
+    events = s.events
+    unused = s.trial_order.unused + s.reasons.unused()
+    datafile = os.path.join(tmpdir, 'subject.vcx')
+    csv_file = os.path.join(tmpdir, 'export.csv')
+
+    def clear_caches():
+        events.invalidate()
+        s.export_cache.clear()
+
+    operations = {
+        'error_items': lambda: events.error_items(unused, s.trial_order.max_trial),
+        'render': lambda: events.render(s.timecode_offsets, tc),
+        'frames': events.frames,
+        'intervals': events.intervals,
+        'export_long': lambda: export_long(csv_file, s, INVERT_TRIAL_ORDER),
+        'export_wide': lambda: export_wide(csv_file, s, INVERT_TRIAL_ORDER),
+        'reliability_report': lambda: reliability_report(s, s2, tc),
+        'save': lambda: save_datafile(datafile, s.to_plist()),
+        'load': lambda: Subject().from_datafile(datafile),
+    }
+    times = {}
+    for name, func in operations.items():
+        if args.operations and name not in args.operations:
+            continue
+        if name == 'load' and not os.path.exists(datafile):
+            save_datafile(datafile, s.to_plist())
+        times[name] = best_of(func, args.repeat, setup=clear_caches)
+    return len(events), times
+
+
+def slope(sizes, times):
+    """Fit log(time) = slope * log(size) + c, returning the slope"""
+    if len(sizes) < 2 or min(times) <= 0:
+        return None
+    return float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.data_bench', description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='25,50,100,200,400',
+                        help='comma-separated numbers of trials (default: %(default)s)')
+    parser.add_argument('--events', type=int, default=10, help='events per trial (default: %(default)s)')
+    parser.add_argument('--offsets', type=int, default=3, help='timecode offsets (default: %(default)s)')
+    parser.add_argument('--frames-per-event', type=int, default=20,
+                        help='mean frames between events (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each operation; the fastest is reported (default: %(default)s)')
+    parser.add_argument('--operations', type=lambda text: text.split(','),
+                        help='comma-separated operations to run (default: all)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('-o', '--output', default='-', help='JSON results file (default: standard output)')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='peyecoder-bench-')
+    sizes = []
+    results = {}
+    try:
+        for trials in (int(size) for size in args.sizes.split(',')):
+            print('{} trials'.format(trials), file=sys.stderr)
+            n_events, times = bench_size(trials, args, tmpdir)
+            sizes.append({'trials': trials, 'events': n_events})
+            for name, t in times.items():
+                results.setdefault(name, []).append(t)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    event_counts = [size['events'] for size in sizes]
+    operations = {name: {'time_ms': [t * 1000 for t in times], 'slope': slope(event_counts, times)}
+                  for name, times in results.items()}
+    for name, result in operations.items():
+        print('{:20} {:>10.2f} ms  slope {}'.format(
+            name, result['time_ms'][-1], 'n/a' if result['slope'] is None else '{:.2f}'.format(result['slope'])),
+            file=sys.stderr)
+    write_results(args.output, 'data', {'sizes': sizes, 'operations': operations,
+                                        'peak_memory_bytes': peak_memory()}, vars(args))
+
+
+if __name__ == '__main__':
+    main()
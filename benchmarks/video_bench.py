@@ -0,0 +1,193 @@
+"""Benchmark video decoding, seeking and frame display
+
+Synthetic videos are generated with OpenCV's VideoWriter at each resolution.  If ffmpeg is available, each
+video is re-encoded with each GOP length (the number of frames between keyframes), which determines how far the
+decoder must go back to seek to a frame.  For each video, the benchmark measures:
+ - filling the frame buffer when a video is opened (frames per second) and the memory it uses
+ - the latency of BufferedVideoReader.next(), prev() and goto_framenumber()
+ - converting, scaling and displaying a frame as MainWindow.show_frame does (only if PySide2 is installed)
+
+Example:
+    python -m benchmarks.video_bench --resolutions 640x480,1280x720 --gop 12,250 --output video.json
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.common import summarize, time_calls, peak_memory, write_results
+from peyecoder.av_utils import assert_ffmpeg
+from peyecoder.video_reader import BufferedVideoReader
+
+
+def make_video(filename, width, height, frame_count, frame_rate=30):
+    """Write a synthetic video with moving content, so that consecutive frames differ as in a real recording"""
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), frame_rate, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError('Unable to write video {}'.format(filename))
+    x = np.arange(width, dtype=np.uint16)
+    y = np.arange(height, dtype=np.uint16)[:, np.newaxis]
+    frame = np.empty((height, width, 3), np.uint8)
+    for i in range(frame_count):
+        frame[:, :, 0] = (x + 2 * i) % 256
+        frame[:, :, 1] = (y + i) % 256
+        frame[:, :, 2] = ((x + y) // 4 + 3 * i) % 256
+        cv2.putText(frame, str(i), (width // 10, height // 2), cv2.FONT_HERSHEY_SIMPLEX, height / 200,
+                    (255, 255, 255), max(1, height // 100))
+        writer.write(frame)
+    writer.release()
+
+
+def reencode(filename, output_filename, gop):
+    """Re-encode a video with ffmpeg so that it has a keyframe every gop frames"""
+    subprocess.run(['ffmpeg', '-y', '-i', filename, '-c:v', 'mpeg4', '-q:v', '4', '-g', str(gop),
+                    '-keyint_min', str(gop), '-sc_threshold', '0', output_filename],
+                   check=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+
+def buffer_bytes(vid):
+    return sum(frame.nbytes for frame_number, frame in vid.buffer)
+
+
+def bench_reader(filename, buffer_len, seeks, rnd):
+    """Measure opening a video and moving through it with BufferedVideoReader"""
+    t0 = time.perf_counter()
+    vid = BufferedVideoReader(filename, buffer_len)
+    open_time = time.perf_counter() - t0
+    frame_count = int(vid.frame_count)
+
+    results = {
+        'frame_count': frame_count,
+        'fourcc': vid.fourcc,
+        'open_ms': open_time * 1000,
+        'buffer_fill_fps': len(vid.buffer) / open_time if open_time else None,
+        'buffer_bytes': buffer_bytes(vid),
+    }
+
+    # step forward through the video from the end of the buffer, reading each frame from the file
+    vid.goto_framenumber(len(vid.buffer) - 1)
+    steps = frame_count - len(vid.buffer) - 1
+    results['next'] = summarize(time_calls(vid.next, [()] * steps))
+    # step back within the buffer
+    results['prev_buffered'] = summarize(time_calls(vid.prev, [()] * (buffer_len - 1)))
+    # step back past the start of the buffer, which reloads it
+    vid.goto_framenumber(frame_count - 1)
+    results['prev_reload'] = summarize(time_calls(lambda: vid.prev(buffer_len + 1),
+                                                  [()] * max(1, (frame_count - buffer_len) // (buffer_len + 1))))
+    # jump to random frames, as when clicking on the position slider
+    targets = [(rnd.randrange(frame_count - 1),) for i in range(seeks)]
+    results['goto'] = summarize(time_calls(vid.goto_framenumber, targets))
+    # jump a short distance forward (e.g., to the next event)
+    vid.goto_framenumber(0)
+    results['goto_forward_short'] = summarize(time_calls(lambda: vid.next(buffer_len // 2),
+                                                         [()] * ((frame_count - buffer_len) // (buffer_len // 2))))
+    return vid, results
+
+
+def bench_display(vid, size, repeat):
+    """Measure the steps of MainWindow.show_frame: wrapping the frame in a QImage, drawing occluders, scaling to
+    the size of the window and converting to a pixmap.  Returns None if PySide2 is not installed.
+    """
+    try:
+        from PySide2 import QtCore, QtGui
+    except ImportError:
+        return None
+    # a QGuiApplication is needed to create pixmaps; use the offscreen platform so no display is needed
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QtGui.QGuiApplication.instance() or QtGui.QGuiApplication([])  # noqa: F841 (must stay alive)
+
+    frame = vid.frame
+    h, w, d = frame.shape
+    occluders = [(0, 0, w // 4, h // 4), (w // 2, h // 2, w // 8, h // 8)]
+    convert, occlude, scale, pixmap = [], [], [], []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        image = QtGui.QImage(frame.data, w, h, w * d, QtGui.QImage.Format_RGB888)
+        t1 = time.perf_counter()
+        painter = QtGui.QPainter(image)
+        for occluder in occluders:
+            painter.fillRect(QtCore.QRect(*occluder), QtCore.Qt.gray)
+        painter.end()
+        t2 = time.perf_counter()
+        image_scaled = image.scaled(size[0], size[1], QtCore.Qt.KeepAspectRatio,
+                                    QtCore.Qt.TransformationMode.SmoothTransformation)
+        t3 = time.perf_counter()
+        QtGui.QPixmap.fromImage(image_scaled)
+        t4 = time.perf_counter()
+        convert.append(t1 - t0)
+        occlude.append(t2 - t1)
+        scale.append(t3 - t2)
+        pixmap.append(t4 - t3)
+    return {'convert': summarize(convert), 'occluders': summarize(occlude), 'scale': summarize(scale),
+            'pixmap': summarize(pixmap)}
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.video_bench', description=__doc__.split('\n')[0])
+    parser.add_argument('--resolutions', default='320x240,640x480,1280x720',
+                        help='comma-separated video sizes (default: %(default)s)')
+    parser.add_argument('--gop', default='12,250',
+                        help='comma-separated GOP lengths, used if ffmpeg is available (default: %(default)s)')
+    parser.add_argument('--frames', type=int, default=600, help='frames in each video (default: %(default)s)')
+    parser.add_argument('--buffer', type=int, default=100, help='frame buffer length (default: %(default)s)')
+    parser.add_argument('--seeks', type=int, default=100, help='random seeks per video (default: %(default)s)')
+    parser.add_argument('--display-size', default='960x540', help='window size for frame display '
+                                                                  '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for seek targets')
+    parser.add_argument('--video-dir', help='keep the generated videos in this directory (reused if present)')
+    parser.add_argument('-o', '--output', default='-', help='JSON results file (default: standard output)')
+    args = parser.parse_args(argv)
+
+    if args.frames <= 2 * args.buffer:
+        parser.error('--frames must be more than twice --buffer')
+
+    gops = [int(g) for g in args.gop.split(',')] if args.gop else []
+    if gops and not assert_ffmpeg():
+        print('ffmpeg not found; using the GOP length chosen by OpenCV', file=sys.stderr)
+        gops = []
+
+    video_dir = args.video_dir or tempfile.mkdtemp(prefix='peyecoder-bench-')
+    os.makedirs(video_dir, exist_ok=True)
+    rnd = random.Random(args.seed)
+    results = []
+    try:
+        for width, height in (parse_size(r) for r in args.resolutions.split(',')):
+            base = os.path.join(video_dir, '{}x{}_{}.mp4'.format(width, height, args.frames))
+            if not os.path.exists(base):
+                make_video(base, width, height, args.frames)
+            videos = [(None, base)]
+            for gop in gops:
+                filename = base.replace('.mp4', '_gop{}.mp4'.format(gop))
+                if not os.path.exists(filename):
+                    reencode(base, filename, gop)
+                videos.append((gop, filename))
+
+            for gop, filename in videos:
+                print('{}x{} GOP {}'.format(width, height, gop or 'default'), file=sys.stderr)
+                vid, result = bench_reader(filename, args.buffer, args.seeks, rnd)
+                result.update({'width': width, 'height': height, 'gop': gop,
+                               'display': bench_display(vid, parse_size(args.display_size), args.seeks)})
+                del vid
+                results.append(result)
+    finally:
+        if not args.video_dir:
+            shutil.rmtree(video_dir, ignore_errors=True)
+
+    write_results(args.output, 'video', {'videos': results, 'peak_memory_bytes': peak_memory()}, vars(args))
+
+
+if __name__ == '__main__':
+    main()
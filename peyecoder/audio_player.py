@@ -1,5 +1,4 @@
 import wave
-import pyaudio
 import os
 from peyecoder.av_utils import extract_sound
 
@@ -57,6 +56,10 @@ class AudioPlayer:
         self.params = self.reader.getparams()  # (nchannels, sampwidth, framerate, nframes, comptype, compname)
         self.chunk_size = int(self.params.framerate / steps_per_second)
 
+        # PyAudio is imported here, rather than at the top of the module, so that it is only loaded once a video
+        # with audio is opened
+        import pyaudio
+        self.pyaudio = pyaudio
         self.p = pyaudio.PyAudio()
         self.player = None
         self.playing = False
@@ -68,7 +71,7 @@ class AudioPlayer:
                 data = self.reader.readframes(self.chunk_size)
             else:
                 data = b'\x00' * 4 * frame_count
-            return data, pyaudio.paContinue
+            return data, self.pyaudio.paContinue
 
         self.player = self.p.open(format=self.p.get_format_from_width(self.params.sampwidth),
                                   channels=self.params.nchannels,
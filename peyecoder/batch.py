@@ -0,0 +1,340 @@
+"""Batch processing of peyecoder data files from the command line, without the GUI
+
+Examples:
+    peyecoder-batch export --format long --output-dir csv 'data/**/*.vcx'
+    peyecoder-batch export --format wide --combined all.csv 'data/**/*.vcx'
+    peyecoder-batch validate 'data/**/*.vcx'
+    peyecoder-batch reliability --primary primary --reliability reliability --output-dir reports
+    peyecoder-batch convert --binary --output-dir binary 'data/**/*.vcx'
+    peyecoder-batch --profile export.prom export --format long --output-dir csv 'data/**/*.vcx'
+
+File arguments may be glob patterns (quote them to stop the shell expanding them); '**' matches any number of
+directories.  A directory stands for all of the data files in it (including subdirectories).  Files are processed
+in parallel on a pool of worker processes.
+
+convert saves data files in the binary format (--binary), which is smaller and faster to load, or as XML plists
+(--xml), e.g. to open them in versions of peyecoder which only read XML.  Without --output-dir, files are replaced.
+
+--profile FILE saves the number of calls, timings and bytes read for loading data files, exports and reliability
+comparisons, as JSON (if FILE ends in .json) or in the Prometheus text format, e.g. to track nightly exports.
+"""
+
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from collections import Counter
+from functools import partial
+
+import timecode
+
+from peyecoder.models import Subject
+from peyecoder.file_utils import load_datafile, save_datafile
+from peyecoder.export import export_datafile, export_combined, FILE_TYPES, INVERT_TRIAL_ORDER, INVERT_RESPONSE
+from peyecoder.reliability import reliability_stats, comparability_key, frame_confusion, cohens_kappa
+from peyecoder.profiling import profiler
+from peyecoder import pool
+
+INVERT_OPTIONS = {'trial-order': INVERT_TRIAL_ORDER, 'response': INVERT_RESPONSE}
+
+
+def expand_patterns(patterns):
+    """Expand glob patterns to a sorted list of unique filenames"""
+    filenames = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.vcx')
+        matches = glob.glob(pattern, recursive=True)
+        if not matches and os.path.isfile(pattern):
+            matches = [pattern]
+        filenames.update(m for m in matches if os.path.isfile(m))
+    return sorted(filenames)
+
+
+def load_subject(filename, sections=None):
+    subject = Subject()
+    subject.from_datafile(filename, sections=sections)
+    return subject
+
+
+def subject_timecode(subject):
+    """Timecode object used to render timecodes for a subject, as in the GUI when no video is loaded"""
+    framerate_string = '{:.2f}'.format(subject['Framerate']).replace('.00', '')
+    tc = timecode.Timecode(framerate_string)
+    tc.drop_frame = False
+    return tc
+
+
+def output_filename(filename, output_directory, extension):
+    return os.path.join(output_directory, os.path.splitext(os.path.basename(filename))[0] + extension)
+
+
+# Jobs run in worker processes
+
+def export_file(filename, output_directory, export_format, invert_rl, file_type='csv'):
+    """Export a data file to a CSV (or columnar) file in output_directory"""
+    return export_datafile(filename, output_filename(filename, output_directory, FILE_TYPES[file_type]),
+                           export_format, invert_rl, file_type)
+
+
+def validate_file(filename):
+    """Return a list of error messages for a data file"""
+    subject = load_subject(filename)
+    errors, messages = subject.events.error_items(subject.trial_order.unused + subject.reasons.unused(),
+                                                  subject.trial_order.max_trial)
+    error_rows, error_trials = subject.reasons.error_items()
+    if error_trials:
+        messages.append('Mismatch between prescreener 1 and prescreener 2 for trials {}'.format(error_trials))
+    return messages
+
+
+def convert_file(filename, output_directory, binary):
+    """Save a data file in the binary or XML format, in output_directory or (if None) replacing the file"""
+    new_filename = output_filename(filename, output_directory, '.vcx') if output_directory else filename
+    if not save_datafile(new_filename, load_datafile(filename), binary=binary):
+        raise OSError('Could not save {}'.format(new_filename))
+    return new_filename
+
+
+def subject_key(filename):
+    """Return the values which must match for subjects to be compared (see reliability.comparability_key)"""
+    return comparability_key(load_subject(filename, Subject.fieldnames + ('Trial Order',)))
+
+
+def reliability_file(primary, reliability, report_filename):
+    """Write a reliability report comparing two data files and return the agreement statistics and the
+    frame confusion counts
+    """
+    s1 = load_subject(primary)
+    s2 = load_subject(reliability)
+    report, stats = reliability_stats(s1, s2, subject_timecode(s1))
+    if report_filename:
+        with open(report_filename, 'w') as f:
+            f.write('\n'.join(report) + '\n')
+    return stats, frame_confusion(s1, s2)
+
+
+def run_jobs(func, jobs, processes=None):
+    """Run func(filename, *args) for each (filename, *args) in jobs on a process pool, reporting progress.
+    :return: dictionary of results and dictionary of error messages, both keyed by filename
+    """
+    results = {}
+    failures = {}
+    for index, result, error in run_jobs_ordered(func, jobs, processes):
+        if error:
+            failures[jobs[index][0]] = error
+        else:
+            results[jobs[index][0]] = result
+    return results, failures
+
+
+def run_jobs_ordered(func, jobs, processes=None):
+    """Run func(filename, *args) for each (filename, *args) in jobs on a process pool, reporting progress.
+    Results are generated in the order of the jobs, as (index, result, error message) tuples (see pool.run_jobs).
+    """
+    for index, result, error in pool.run_jobs(func, jobs, processes):
+        print('[{}/{}] {} {}'.format(index + 1, len(jobs), 'FAILED' if error else 'ok', jobs[index][0]),
+              file=sys.stderr)
+        yield index, result, error
+
+
+def print_summary(command, n_files, failures, t0):
+    print('{}: processed {} file(s) in {:.1f} s, {} failed'.format(command, n_files, time.perf_counter() - t0,
+                                                                  len(failures)), file=sys.stderr)
+    for filename, msg in sorted(failures.items()):
+        print('  {}: {}'.format(filename, msg), file=sys.stderr)
+
+
+def export_command(args):
+    filenames = expand_patterns(args.files)
+    if args.file_type != 'csv' and args.format != 'long':
+        print('{} export is only available for long format (--format long)'.format(args.file_type), file=sys.stderr)
+        return 2
+    if args.combined:
+        if args.file_type != 'csv':
+            print('--combined is only available for CSV export', file=sys.stderr)
+            return 2
+        return export_combined_command(args, filenames)
+    os.makedirs(args.output_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    results, failures = run_jobs(export_file, [(f, args.output_dir, args.format, INVERT_OPTIONS[args.invert],
+                                                args.file_type) for f in filenames], args.jobs)
+    print_summary('export', len(filenames), failures, t0)
+    return 1 if failures else 0
+
+
+def export_combined_command(args, filenames):
+    """Export files to a single CSV file with one header, in the order of the filenames"""
+    t0 = time.perf_counter()
+    failures = export_combined(args.combined, filenames, args.format, INVERT_OPTIONS[args.invert],
+                               partial(run_jobs_ordered, processes=args.jobs))
+    print_summary('export', len(filenames), dict(failures), t0)
+    return 1 if failures else 0
+
+
+def validate_command(args):
+    filenames = expand_patterns(args.files)
+    t0 = time.perf_counter()
+    results, failures = run_jobs(validate_file, [(f,) for f in filenames], args.jobs)
+    invalid = 0
+    for filename in sorted(results):
+        if results[filename]:
+            invalid += 1
+            print(filename)
+            for msg in results[filename]:
+                print('  ' + msg)
+    print_summary('validate', len(filenames), failures, t0)
+    print('{} file(s) with errors'.format(invalid), file=sys.stderr)
+    return 1 if failures or invalid else 0
+
+
+def convert_command(args):
+    filenames = expand_patterns(args.files)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    results, failures = run_jobs(convert_file, [(f, args.output_dir, args.binary) for f in filenames], args.jobs)
+    print_summary('convert', len(filenames), failures, t0)
+    return 1 if failures else 0
+
+
+def reliability_command(args):
+    primary_files = expand_patterns(args.primary)
+    reliability_files = expand_patterns(args.reliability)
+    t0 = time.perf_counter()
+
+    # Pair primary and reliability files for the same subject (same number, trial order, birthday and date of
+    # test), using an index of the reliability files by subject
+    keys, failures = run_jobs(subject_key, [(f,) for f in primary_files + reliability_files], args.jobs)
+    for filename in sorted(f for f, key in keys.items() if key is None):
+        print("Birthday or date of test can't be read in {}".format(filename), file=sys.stderr)
+    index = {}
+    for filename in reliability_files:
+        if keys.get(filename) is not None:
+            index.setdefault(keys[filename], []).append(filename)
+    pairs = []
+    for filename in primary_files:
+        if keys.get(filename) is None:
+            continue
+        others = index.get(keys[filename], [])
+        if not others:
+            print('No reliability file for {}'.format(filename), file=sys.stderr)
+        for other in others:
+            pairs.append((filename, other))
+
+    jobs = []
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for primary, other in pairs:
+        report_filename = None
+        if args.output_dir:
+            report_filename = output_filename(primary, args.output_dir, '.txt')
+            if len(index[keys[primary]]) > 1:
+                # more than one reliability file for this subject, so include both names in the report name
+                report_filename = report_filename[:-4] + '_' + os.path.splitext(os.path.basename(other))[0] + '.txt'
+        jobs.append((primary, other, report_filename))
+
+    percentages = ('Frame agreement', 'Comparable trials', 'Shift agreement')
+    counts = ('Deletions', 'Insertions')
+    fields = ('Primary', 'Reliability', 'Frame agreement', 'Frame kappa', 'Comparable trials', 'Shift agreement',
+              'Deletions', 'Insertions')
+    writer = csv.DictWriter(sys.stdout, fieldnames=fields, dialect='excel')
+    writer.writeheader()
+    study_stats = []
+    study_confusion = Counter()
+    results = run_jobs_ordered(reliability_file, jobs, args.jobs)
+    for (primary, other, _), (_, result, error) in zip(jobs, results):
+        if error:
+            failures['{} / {}'.format(primary, other)] = error
+            continue
+        stats, confusion = result
+        study_stats.append(stats)
+        study_confusion.update(confusion)
+        row = {k: '{:.2f}'.format(stats[k]) for k in percentages}
+        row.update({k: stats[k] for k in counts})
+        writer.writerow(dict(row, Primary=primary, Reliability=other, **{'Frame kappa': format_kappa(confusion)}))
+
+    # Study-wide summary: mean agreement over all pairs, kappa over the frames of all pairs, and total counts of
+    # unmatched responses
+    if study_stats:
+        row = {k: '{:.2f}'.format(sum(stats[k] for stats in study_stats) / len(study_stats)) for k in percentages}
+        row.update({k: sum(stats[k] for stats in study_stats) for k in counts})
+        writer.writerow(dict(row, Primary='All pairs', Reliability='{} pairs'.format(len(study_stats)),
+                             **{'Frame kappa': format_kappa(study_confusion)}))
+    print_summary('reliability', len(pairs), failures, t0)
+    return 1 if failures else 0
+
+
+def format_kappa(confusion):
+    kappa = cohens_kappa(confusion)
+    return 'N/A' if kappa is None else '{:.3f}'.format(kappa)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='peyecoder-batch',
+                                     description='Process peyecoder data files (.vcx) without the GUI.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='save timings of loading, export and reliability to FILE (JSON if FILE ends in .json, '
+                             'otherwise Prometheus text format)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser('export', help='export data files to CSV files')
+    export_parser.add_argument('files', nargs='+', help='data files or glob patterns')
+    output_group = export_parser.add_mutually_exclusive_group(required=True)
+    output_group.add_argument('-o', '--output-dir', help='directory for exported files (one for each data file)')
+    output_group.add_argument('--combined', metavar='FILE', help='export all data files to a single CSV file')
+    export_parser.add_argument('--format', choices=('wide', 'long'), default='wide')
+    export_parser.add_argument('--file-type', choices=sorted(FILE_TYPES), default='csv',
+                               help='parquet and feather (long format only) require pyarrow')
+    export_parser.add_argument('--invert', choices=sorted(INVERT_OPTIONS), default='trial-order',
+                               help='left-right inversion (default: trial-order, as in iCoder)')
+    export_parser.set_defaults(func=export_command)
+
+    validate_parser = subparsers.add_parser('validate', help='check data files for coding errors')
+    validate_parser.add_argument('files', nargs='+', help='data files or glob patterns')
+    validate_parser.set_defaults(func=validate_command)
+
+    reliability_parser = subparsers.add_parser('reliability',
+                                               help='compare primary and reliability coding of the same subjects')
+    reliability_parser.add_argument('--primary', nargs='+', required=True,
+                                    help='primary data files, directories or glob patterns')
+    reliability_parser.add_argument('--reliability', nargs='+', required=True,
+                                    help='reliability data files, directories or glob patterns, paired with primary '
+                                         'files by subject number, trial order, birthday and date of test')
+    reliability_parser.add_argument('-o', '--output-dir', help='directory for reliability reports')
+    reliability_parser.set_defaults(func=reliability_command)
+
+    convert_parser = subparsers.add_parser('convert', help='save data files in the binary or XML format')
+    convert_parser.add_argument('files', nargs='+', help='data files or glob patterns')
+    format_group = convert_parser.add_mutually_exclusive_group(required=True)
+    format_group.add_argument('--binary', action='store_true', help='binary format (smaller and faster to load)')
+    format_group.add_argument('--xml', dest='binary', action='store_false', help='XML plist format')
+    convert_parser.add_argument('-o', '--output-dir',
+                                help='directory for converted files (default: replace the original files)')
+    convert_parser.set_defaults(func=convert_command)
+    return parser
+
+
+def run(argv=None):
+    """Run peyecoder-batch, returning the exit status"""
+    args = build_parser().parse_args(argv)
+    if args.profile:
+        profiler.enabled = True
+        profiler.reset()
+        status = args.func(args)
+        profiler.write(args.profile)
+        return status
+    return args.func(args)
+
+
+def main():
+    sys.exit(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Parsing of dates entered for subjects (birthday, date of test)
+
+import datetime
+import re
+import time
+from functools import lru_cache
+
+# US-style dates (MM/DD/YY, MM/DD/YYYY, also with - separators) and ISO dates (YYYY-MM-DD)
+US_DATE = re.compile(r'\s*(\d{1,2})([/-])(\d{1,2})\2(\d{4}|\d{2})\s*$')
+ISO_DATE = re.compile(r'\s*(\d{4})-(\d{1,2})-(\d{1,2})\s*$')
+
+
+def convert_year(year):
+    """Convert a two-digit year to a year within 50 years of the current year, as dateutil does"""
+    current_year = time.localtime().tm_year
+    year += current_year // 100 * 100
+    if year >= current_year + 50:
+        year -= 100
+    elif year < current_year - 50:
+        year += 100
+    return year
+
+
+# Result cached by _cached_parse_date for a string which is not a date
+_INVALID_DATE = object()
+
+
+def parse_date(datestr):
+    """Convert a string to a date, interpreting ambiguous dates as month first.
+    Dates in the formats used by peyecoder are parsed directly; anything else is parsed by dateutil.parser, which
+    gives the same results for these formats but is much slower.  Results are cached, including failures (e.g., a
+    blank birthday), which raise ValueError each time.
+    """
+    result = _cached_parse_date(datestr)
+    if result is _INVALID_DATE:
+        raise ValueError('Unable to parse date: {!r}'.format(datestr))
+    return result
+
+
+@lru_cache(maxsize=1024)
+def _cached_parse_date(datestr):
+    try:
+        return _parse_date(datestr)
+    except (ValueError, OverflowError):
+        return _INVALID_DATE
+
+
+def _parse_date(datestr):
+    match = US_DATE.match(datestr)
+    if match:
+        month, _, day, year = match.groups()
+        try:
+            return datetime.date(convert_year(int(year)) if len(year) == 2 else int(year), int(month), int(day))
+        except ValueError:
+            pass  # e.g., day first (13/02/20), which dateutil can interpret
+    else:
+        match = ISO_DATE.match(datestr)
+        if match:
+            try:
+                return datetime.date(*(int(g) for g in match.groups()))
+            except ValueError:
+                pass
+
+    from dateutil import parser  # imported on first use, since dateutil is slow to import
+    return parser.parse(datestr, dayfirst=False).date()
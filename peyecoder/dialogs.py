@@ -2,38 +2,52 @@ from PySide2 import QtGui
 from PySide2.QtWidgets import QLabel, QLineEdit, QPushButton, \
     QHBoxLayout, QVBoxLayout, QGridLayout, QDialog, QFileDialog, \
     QRadioButton, QButtonGroup, QDialogButtonBox, QCheckBox, QPlainTextEdit, QFrame, \
-    QTableWidget, QHeaderView, QTableWidgetItem, QSizePolicy, QMessageBox
+    QTableWidget, QHeaderView, QTableWidgetItem, QSizePolicy, QMessageBox, QProgressDialog, QApplication
 
 from PySide2.QtGui import Qt, QIntValidator, QRegExpValidator, QKeySequence
-from PySide2.QtCore import QRect, QRegExp, Signal
+from PySide2.QtCore import QRegExp, Signal
 
-from dateutil import parser
 from urllib.parse import urlparse
 from urllib.request import url2pathname
 
 import timecode
 import os
 import re
+from bisect import bisect_left
 
-from peyecoder.models import Occluders, Subject
+from peyecoder.models import Occluders, Subject, Rect, TrialOrder
 from peyecoder.panels import LogTable
-from peyecoder.file_utils import load_datafile
-from peyecoder.export import export, INVERT_RESPONSE, INVERT_TRIAL_ORDER
+from peyecoder.export import export, export_datafile, export_combined, FILE_TYPES, INVERT_RESPONSE, \
+    INVERT_TRIAL_ORDER
+from peyecoder import pool
+from peyecoder.history import ReplaceResponses
+from peyecoder.reliability import DisagreementIndex
+from peyecoder.date_utils import parse_date
 
 
 def get_save_filename(parent, caption, filter, default_suffix=''):
     """ Use a custom save dialog instead of the convenience function to support default suffix"""
+    return get_save_filename_and_filter(parent, caption, filter, default_suffix)[0]
+
+
+def get_save_filename_and_filter(parent, caption, filter, default_suffix='', selected_filter=''):
+    """Like get_save_filename, but also return the file type filter which was selected
+    :param selected_filter: Filter to select initially
+    :return: filename (or '' if cancelled) and filter
+    """
     dialog = QFileDialog(parent, caption=caption, filter=filter)
     dialog.setOption(QFileDialog.DontUseNativeDialog)
     dialog.setAcceptMode(QFileDialog.AcceptSave)
     dialog.setFileMode(QFileDialog.AnyFile)
     if default_suffix:
         dialog.setDefaultSuffix(default_suffix)
+    if selected_filter:
+        dialog.selectNameFilter(selected_filter)
     if dialog.exec_():
         filenames = dialog.selectedFiles()
         if filenames:
-            return filenames[0]
-    return ''
+            return filenames[0], dialog.selectedNameFilter()
+    return '', ''
 
 
 class FileDropTarget(QLabel):
@@ -180,14 +194,20 @@ class SubjectDialog(QDialog):
 
     def update_trial_order(self, filename):
         """ When a trial order file is dragged into the subject dialog, read the file into TrialOrder object"""
-        self.parent().subject.trial_order.read_trial_order(filename)
+        trial_order = TrialOrder()
+        trial_order.read_trial_order(filename)
+        self.parent().subject.set_trial_order(trial_order)
         self.trial_order_box.setText(self.parent().subject.trial_order.name())
         self.sync_fields()
 
     def update_age(self):
+        if not (self.dob_box.text() and self.participation_date_box.text()):
+            # Nothing to parse, e.g. when the dialog is first shown at startup
+            self.months_label.setText('-- Months')
+            return
         try:
-            dob = parser.parse(self.dob_box.text(), dayfirst=False).date()
-            participation_date = parser.parse(self.participation_date_box.text(), dayfirst=False).date()
+            dob = parse_date(self.dob_box.text())
+            participation_date = parse_date(self.participation_date_box.text())
             age_days = (participation_date - dob).days
             age_months = age_days / 30.44
             self.months_label.setText('{:0.1f} Months'.format(age_months))
@@ -315,21 +335,20 @@ class OccluderDialog(QDialog):
         for rect in self.parent().subject.occluders:
             row = self.table.rowCount()
             self.add_row()
-            for col, item in enumerate(rect.getRect()):
+            for col, item in enumerate(rect):
                 self.table.setItem(row, col, QTableWidgetItem(str(item)))
 
     def save_occluders(self):
         occluders = []
         for r in range(self.table.rowCount()):
             try:
-                r = QRect(*[int(self.table.item(r, c).text()) for c in range(4)])
+                r = Rect(*[int(self.table.item(r, c).text()) for c in range(4)])
                 occluders.append(r)
             except (AttributeError, ValueError):
                 # AttributeError occurs for blank cells
                 # ValueError occurs for cells containing non-integer text
                 pass
-        self.parent().subject.occluders = Occluders(occluders)
-        self.parent().subject.dirty = True
+        self.parent().subject.set_occluders(Occluders(occluders))
         self.parent().vid.reload_buffer()
         self.parent().show_frame()
 
@@ -490,15 +509,16 @@ class SettingsDialog(QDialog):
         self.ffmpeg.setText(self.parent().settings.value('ffmpeg', 'ffmpeg'))
 
     def save_settings(self):
+        self.parent().subject.update_settings({
+            'Step': int(self.step_box.text()),
+            'Response Keys': self.key_table.to_dict(),
+            'Toggle Trial Status Key': self.toggle_box.get_key()
+        })
         d = self.parent().subject.settings
-        d['Step'] = int(self.step_box.text())
-        d['Response Keys'] = self.key_table.to_dict()
-        d['Toggle Trial Status Key'] = self.toggle_box.get_key()
         # Update step label on main form
         self.parent().step_label.setText('Step: {}'.format(d['Step']))
         # update code responses to reflect current response keys
         self.parent().code_tab.set_responses(list(d['Response Keys'].values()))
-        self.parent().subject.dirty = True
         self.parent().settings.setValue('ffmpeg', self.ffmpeg.text())
 
     def show(self):
@@ -517,6 +537,7 @@ class CodeComparisonDialog(QDialog):
         super().__init__(parent)
 
         self.frames = []
+        self.disagreements = None  # DisagreementIndex comparing the parent's subject with this subject
 
         self.subject = Subject()
         layout = QVBoxLayout()
@@ -541,9 +562,10 @@ class CodeComparisonDialog(QDialog):
 
     def load_data(self, filename):
         self.frames = []
+        self.disagreements = None
         self.setWindowTitle(os.path.basename(filename))
         self.subject = Subject()
-        self.subject.from_plist(load_datafile(filename))
+        self.subject.from_datafile(filename)
 
         self.update_table()
 
@@ -551,10 +573,18 @@ class CodeComparisonDialog(QDialog):
         self.logtable.load_data(self.subject.events.render(self.subject.timecode_offsets, self.parent().timecode))
         self.frames = [e.frame for e in self.subject.events]
 
+    def compare(self, subject):
+        """Find the frames where another subject (normally the one being coded) disagrees with this subject"""
+        self.disagreements = DisagreementIndex(subject, self.subject)
+
     def scroll_to_frame(self, frame):
         # Scroll to and highlight the row closest to the supplied frame number
-        d = [abs(f - frame) for f in self.frames]
-        row = d.index(min(d))
+        if not self.frames:
+            return
+        row = bisect_left(self.frames, frame)
+        if row == len(self.frames) or (row > 0 and frame - self.frames[row - 1] <= self.frames[row] - frame):
+            row -= 1
+        row = bisect_left(self.frames, self.frames[row])  # first of any rows with the same frame
         self.logtable.scrollToItem(self.logtable.item(row, 0))
 
         self.logtable.clearSelection()
@@ -604,6 +634,17 @@ class ExportDialog(QDialog):
         self.invert_radiogroup.addButton(self.invert_response_radio, id=INVERT_RESPONSE)
         self.invert_trial_order_radio.setChecked(True)  # default to iCoder-style inversion
 
+        self.file_type_label = QLabel('File Type:')
+        self.csv_radio = QRadioButton('CSV')
+        self.parquet_radio = QRadioButton('Parquet (long format only)')
+        self.feather_radio = QRadioButton('Feather (long format only)')
+        self.file_type_radiogroup = QButtonGroup()
+        self.file_type_radiogroup.addButton(self.csv_radio, id=1)
+        self.file_type_radiogroup.addButton(self.parquet_radio, id=2)
+        self.file_type_radiogroup.addButton(self.feather_radio, id=3)
+        self.csv_radio.setChecked(True)  # default CSV
+        self.file_type_radiogroup.buttonClicked.connect(self.update_file_type)
+
         if bulk:
             self.output_label = QLabel('File Management:')
             self.separate_radio = QRadioButton('One CSV for each VCX file')
@@ -628,18 +669,49 @@ class ExportDialog(QDialog):
         layout.addWidget(self.invert_label)
         layout.addWidget(self.invert_trial_order_radio)
         layout.addWidget(self.invert_response_radio)
+        layout.addWidget(self.file_type_label)
+        layout.addWidget(self.csv_radio)
+        layout.addWidget(self.parquet_radio)
+        layout.addWidget(self.feather_radio)
         if bulk:
             layout.addWidget(self.output_label)
             layout.addWidget(self.separate_radio)
             layout.addWidget(self.combined_radio)
         layout.addWidget(self.button_box)
         self.setLayout(layout)
+        self.bulk = bulk
+
+    def file_type(self):
+        return {1: 'csv', 2: 'parquet', 3: 'feather'}[self.file_type_radiogroup.checkedId()]
+
+    def file_type_name(self):
+        return {1: 'CSV', 2: 'Parquet', 3: 'Feather'}[self.file_type_radiogroup.checkedId()]
+
+    def update_file_type(self):
+        # Columnar files are only available in long format, and can't be combined
+        columnar = self.file_type() != 'csv'
+        if columnar:
+            self.long_radio.setChecked(True)
+        self.wide_radio.setEnabled(not columnar)
+        if self.bulk:
+            if columnar:
+                self.separate_radio.setChecked(True)
+            self.combined_radio.setEnabled(not columnar)
 
     def export_csv(self):
-        filename = get_save_filename(self, "Save CSV File", filter="CSV Files (*.csv)", default_suffix='csv')
+        file_type = self.file_type()
+        filename = get_save_filename(self, "Save {} File".format(self.file_type_name()),
+                                     filter="{} Files (*{})".format(self.file_type_name(), FILE_TYPES[file_type]),
+                                     default_suffix=FILE_TYPES[file_type][1:])
         if filename != '':
             export_format = {1: 'wide', 2: 'long'}[self.format_radiogroup.checkedId()]
-            export(filename, self.parent().subject, format=export_format, invert_rl=self.invert_radiogroup.checkedId())
+            try:
+                export(filename, self.parent().subject, format=export_format,
+                       invert_rl=self.invert_radiogroup.checkedId(), file_type=file_type)
+            except ImportError as e:
+                QMessageBox.warning(self, 'Export Error', str(e))
+                self.reject()
+                return
             self.accept()
         else:
             self.reject()
@@ -653,30 +725,65 @@ class ExportDialog(QDialog):
 
         export_format = {1: 'wide', 2: 'long'}[self.format_radiogroup.checkedId()]
 
+        invert_rl = self.invert_radiogroup.checkedId()
+        file_type = self.file_type()
+
         if filenames:
             # Select output directory or output file, depending on which kind of output is requested
             if self.output_radiogroup.checkedId() == 1:
                 # individual files
-                output_directory = QFileDialog.getExistingDirectory(self, 'Select folder to save CSV files', options=options)
+                output_directory = QFileDialog.getExistingDirectory(self, 'Select folder to save exported files', options=options)
+                if not output_directory:
+                    self.reject()
+                    return
+                jobs = []
                 for filename in filenames:
-                    subject = Subject()
-                    subject.from_plist(load_datafile(filename))
-                    output_filename = os.path.splitext(os.path.basename(filename))[0] + '.csv'
+                    output_filename = os.path.splitext(os.path.basename(filename))[0] + FILE_TYPES[file_type]
                     output_filename = os.path.join(output_directory, output_filename)
-                    export(output_filename, subject, format=export_format,
-                           invert_rl=self.invert_radiogroup.checkedId())
+                    jobs.append((filename, output_filename, export_format, invert_rl, file_type))
+                results = list(self.run_jobs(export_datafile, jobs))
+                if len(results) < len(jobs):
+                    failures = None  # cancelled
+                else:
+                    failures = [(filenames[index], msg) for index, _, msg in results if msg]
             else:
                 # concatenate output to a single CSV file
                 output_filename = get_save_filename(self, "Select filename for combined CSV File", filter="CSV Files (*.csv)", default_suffix='csv')
-                for idx, filename in enumerate(filenames):
-                    subject = Subject()
-                    subject.from_plist(load_datafile(filename))
-                    export(output_filename, subject, format=export_format,
-                           invert_rl=self.invert_radiogroup.checkedId(), file_mode='a' if idx > 0 else 'w')
-            self.accept()
+                if not output_filename:
+                    self.reject()
+                    return
+                failures = export_combined(output_filename, filenames, export_format, invert_rl, self.run_jobs)
+
+            if failures:
+                QMessageBox.warning(self, 'Export Errors', 'The following files could not be exported:\n\n' +
+                                    '\n'.join('{} ({})'.format(filename, msg) for filename, msg in failures))
+            if failures is None:
+                self.reject()
+            else:
+                self.accept()
         else:
             self.reject()
 
+    def run_jobs(self, func, jobs):
+        """Run func(*args) for each args in jobs on a pool of worker processes (see pool.run_jobs), showing progress
+        and keeping the GUI responsive.  Generates (index, result, error) for each job in order, stopping early if
+        cancelled.
+        """
+        progress = QProgressDialog('Exporting files...', 'Cancel', 0, len(jobs), self)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(0)
+        progress.setValue(0)
+
+        def poll(finished):
+            progress.setValue(finished)
+            QApplication.processEvents()
+            return progress.wasCanceled()
+
+        try:
+            yield from pool.run_jobs(func, jobs, poll=poll)
+        finally:
+            progress.reset()
+
 
 class ReplaceDialog(QDialog):
     """Dialog for find/replace responses"""
@@ -718,22 +825,23 @@ class ReplaceDialog(QDialog):
         case_match = self.case_checkbox.isChecked()
 
         if f and r:
+            replacements = []
             for event in self.parent().subject.events:
                 if case_match:
                     if entire_match:
-                        if event.response == f:
-                            event.response = r
+                        new_response = r if event.response == f else event.response
                     else:
-                        if f in event.response:
-                            event.response = event.response.replace(f, r)
+                        new_response = event.response.replace(f, r)
                 else:
                     if entire_match:
-                        if event.response.lower == f.lower():
-                            event.response = r
+                        new_response = r if event.response.lower() == f.lower() else event.response
                     else:
                         # Use regex for case-insensitive replacement
-                        event.response = re.sub(re.escape(f), r, event.response, flags=re.IGNORECASE)
-            self.parent().update_log()
+                        new_response = re.sub(re.escape(f), r, event.response, flags=re.IGNORECASE)
+                if new_response != event.response:
+                    replacements.append((event, event.response, new_response))
+            if replacements:
+                self.parent().apply_command(ReplaceResponses(replacements))
             super().accept()
         else:
             QMessageBox.warning(self, 'peyecoder', 'Both "find" and "replace" fields must contain text.', QMessageBox.Ok)
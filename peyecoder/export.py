@@ -1,13 +1,33 @@
 
 from peyecoder.models import Subject
+from peyecoder.profiling import profiled
+from peyecoder import pool
 import csv
-from dateutil import parser
+import io
 from math import floor
+from collections import namedtuple
 
 INVERT_TRIAL_ORDER = 1
 INVERT_RESPONSE = 2
 INVERSION = {INVERT_TRIAL_ORDER: 'Trial Order', INVERT_RESPONSE: 'Response'}
 
+# File types for exports, with their file extensions.  Parquet and Feather are columnar formats which are much
+# faster to load into R or pandas than CSV; they require the optional pyarrow package.
+FILE_TYPES = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+# Sections of a data file needed to export a subject (see file_utils.load_datafile)
+EXPORT_SECTIONS = Subject.fieldnames + ('Framerate', 'Responses', 'Trial Order', 'Pre-Screen Information')
+
+
+def subject_age_months(s: Subject):
+    """Compute the age of a subject in months on the date of test"""
+    try:
+        age_days = (s.date('Date of Test') - s.date('Birthday')).days
+    except:
+        # probably missing one of the dates
+        return 0
+    return age_days / 30.44
+
 
 def frame2ms(f, frame_rate=30):
     """Convert a frame number to a time in ms"""
@@ -19,20 +39,6 @@ def ms2frames(ms, frame_rate=30):
     return floor(ms * frame_rate / 1000)
 
 
-def age_months(date_of_birth, date_of_interest):
-    """Compute age in months given a birth date and a second date"""
-    try:
-        d0 = parser.parse(date_of_birth, dayfirst=False).date()
-        d1 = parser.parse(date_of_interest, dayfirst=False).date()
-    except:
-        # probably missing one of the dates
-        return 0
-
-    age_days = (d1 - d0).days
-    age_months_number = age_days / 30.44
-    return age_months_number
-
-
 def compute_accuracy(target, response):
     """Compute accuracy given a target side and a response
     Assume:
@@ -65,15 +71,100 @@ def compute_accuracy(target, response):
     return accuracy
 
 
-def export(filename, s: Subject, format='long', invert_rl=INVERT_TRIAL_ORDER, file_mode='w'):
+# Responses and accuracy for each frame of a trial, counting from the first event of the trial
+#   runs: list of (number of frames, response, accuracy) for each event, in order.  The last event of a trial
+#         continues until the end of the trial (as given by the trial order).
+#   coded: number of frames from the first event of the trial to the last event
+#   accuracy: array of the accuracy of each frame
+TrialSeries = namedtuple('TrialSeries', 'runs coded accuracy')
+
+
+def _subject_cache(s: Subject):
+    """Values cached on a subject by this module, which are discarded whenever the events or trial order change"""
+    cache = s.export_cache
+    if (cache.get('events') is not s.events or cache.get('revision') != s.events.revision or
+            cache.get('trial order') is not s.trial_order.data):
+        cache.clear()
+        cache['events'] = s.events
+        cache['revision'] = s.events.revision
+        cache['trial order'] = s.trial_order.data
+    return cache
+
+
+def trial_series(s: Subject, invert_rl):
+    """Return the responses and accuracy for each frame of each trial, as a TrialSeries for each trial in the trial
+    order.  These are computed once and cached on the subject, and shared by the long and wide exports.
+    :param s: subject object
+    :param invert_rl: controls which L-R elements get inverted
+    """
+    cache = _subject_cache(s)
+    key = ('series', invert_rl)
+    if key not in cache:
+        trial_events = s.events.trials()
+        cache[key] = [_trial_series(trial_info, trial_events.get(trial_info['Trial Number'], []), invert_rl)
+                      for trial_info in s.trial_order.data]
+    return cache[key]
+
+
+def _trial_series(trial_info, events, invert_rl):
+    import numpy as np
+
+    if invert_rl == INVERT_TRIAL_ORDER:
+        target_side = trial_info.inverted_target()
+    else:
+        target_side = trial_info['Target Side']
+
+    # Each event covers the frames from the end of the previous event until the start of the next event
+    # (relative to the first event of the trial), or until the end of the trial for the last event.
+    trial_frames = int(trial_info.get('Trial End', 0) / 100 * 3)
+    event_start = 0
+    runs = []
+    for e in range(len(events)):
+        try:
+            event_end = events[e + 1].frame - events[0].frame
+        except IndexError:
+            event_end = trial_frames
+
+        if invert_rl == INVERT_RESPONSE:
+            response = events[e].inverted_response()
+        else:
+            response = events[e].response
+
+        if event_end > event_start:
+            runs.append((event_end - event_start, response, compute_accuracy(target_side, response)))
+        event_start = event_end
+
+    coded = events[-1].frame - events[0].frame if events else 0
+    accuracy = np.repeat(np.array([accuracy for _, _, accuracy in runs], dtype=object), [n for n, _, _ in runs])
+    return TrialSeries(runs, coded, accuracy)
+
+
+LONG_FIELDS = ('Sub Num', 'Months', 'Sex', 'Trial Order', 'Trial Number', 'Prescreen Notes',
+               'Left Image', 'Center Image', 'Right Image', 'Target Side', 'Inversion', 'Condition',
+               'Time', 'Time Centered', 'Response', 'Accuracy')
+
+WIDE_FIELDS = ('Sub Num', 'Months', 'Sex', 'Order', 'Tr Num', 'Prescreen Notes',
+               'L-image', 'C-image', 'R-image', 'Target Side', 'Target Image', 'Inversion', 'Condition',
+               'CritOnset')
+
+
+@profiled('export')
+def export(filename, s: Subject, format='long', invert_rl=INVERT_TRIAL_ORDER, file_mode='w', file_type='csv'):
     """Export subject data to a .csv file
     :param s: subject object
     :param filename: full path to the destination file
     :param format: 'wide' or 'long' format for the export file
     :param invert_rl: controls which L-R elements get inverted in output file
-    :param file_mode: mode used to open the output file.  Defaults to 'w'
+    :param file_mode: mode used to open the output file.  Defaults to 'w'.  When appending ('a') to a file which
+    is not empty, no header is written, so the columns must match those already in the file.  Use export_combined
+    to combine wide format exports, which can have different columns for each subject.
+    :param file_type: 'csv' (default), or 'parquet' or 'feather' for long format exports (see export_columnar)
     """
-    if format == 'long':
+    if file_type != 'csv':
+        if format != 'long':
+            raise ValueError('{} export is only available for long format'.format(file_type.capitalize()))
+        export_columnar(filename, s, invert_rl, file_type)
+    elif format == 'long':
         export_long(filename, s, invert_rl, file_mode)
     elif format == 'wide':
         export_wide(filename, s, invert_rl, file_mode)
@@ -86,81 +177,162 @@ def export_long(filename, s: Subject, invert_rl, file_mode='w'):
     :param invert_rl: controls which L-R elements get inverted in output file
     :param file_mode: mode used to open the output file.  Defaults to 'w'
     """
-    fields = ('Sub Num', 'Months', 'Sex', 'Trial Order', 'Trial Number', 'Prescreen Notes',
-              'Left Image', 'Center Image', 'Right Image', 'Target Side', 'Inversion', 'Condition',
-              'Time', 'Time Centered', 'Response', 'Accuracy')
+    with open(filename, file_mode, newline='') as f:
+        if f.tell() == 0:
+            # no header when appending to an existing export
+            csv.writer(f, dialect='excel').writerow(LONG_FIELDS)
+        f.writelines(long_csv(s, invert_rl))
+
+
+def long_trials(s: Subject, invert_rl):
+    """Generate the data for each trial of a long format export, so that the rows for a trial can be built in bulk.
+    Yields (values, time, time_centered, events) for each trial, where
+      values: values of the fields which are the same for every row of the trial (LONG_FIELDS up to 'Condition')
+      time, time_centered: arrays of the time (in ms) of each row
+      events: list of (number of rows, response, accuracy) for each event, in order
+    :param s: subject object
+    :param invert_rl: controls which L-R elements get inverted
+    """
+    import numpy as np
 
     frame_rate = round(s['Framerate'])
 
-    with open(filename, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=fields, dialect='excel')
-        writer.writeheader()
+    months = '{:0.1f}'.format(subject_age_months(s))
+    sex = s.get_sex_display()
+    trial_order_name = s.trial_order.name()
+    inversion = INVERSION[invert_rl]
 
-        # one row per frame
-        data = {
-            'Sub Num': s['Number'],
-            'Months': '{:0.1f}'.format(age_months(s['Birthday'], s['Date of Test'])),
-            'Sex': s.get_sex_display(),
-            'Trial Order': s.trial_order.name(),
-            'Prescreen Notes': s['Notes'],
-            'Inversion': INVERSION[invert_rl]
-        }
+    unused = s.trial_order.unused + s.reasons.unused()
+    prescreen_reasons = s.reasons.unused_reasons()
 
-        trial_events = s.events.trials()
-        unused = s.trial_order.unused + s.reasons.unused()
-        prescreen_reasons = s.reasons.unused_reasons()
+    for trial_info, series in zip(s.trial_order.data, trial_series(s, invert_rl)):
+        trial_number = trial_info['Trial Number']
+        if trial_number in unused:
+            continue
 
-        for trial_info in s.trial_order.data:
-            trial_number = trial_info['Trial Number']
-            if trial_number in unused:
-                continue
+        critical_onset_rounded = frame2ms(ms2frames(trial_info['Critical Onset'], frame_rate), frame_rate)
 
-            critical_onset_rounded = frame2ms(ms2frames(trial_info['Critical Onset'], frame_rate), frame_rate)
-            events = trial_events.get(trial_number, [])
+        if invert_rl == INVERT_TRIAL_ORDER:
+            target_side = trial_info.inverted_target()
+            l_image = trial_info['Right Image']
+            r_image = trial_info['Left Image']
+        else:
+            target_side = trial_info['Target Side']
+            l_image = trial_info['Left Image']
+            r_image = trial_info['Right Image']
 
-            if invert_rl == INVERT_TRIAL_ORDER:
-                target_side = trial_info.inverted_target()
-                l_image = trial_info['Right Image']
-                r_image = trial_info['Left Image']
-            else:
-                target_side = trial_info['Target Side']
-                l_image = trial_info['Left Image']
-                r_image = trial_info['Right Image']
-
-            data.update({
-                'Trial Number': trial_number,
-                'Left Image': l_image,
-                'Center Image': trial_info.get('Center Image', ''),
-                'Right Image': r_image,
-                'Target Side': target_side,
-                'Condition': trial_info.get('Condition', ''),
-                'Prescreen Notes': prescreen_reasons.get(trial_number, '')
-            })
-
-            trial_frames = int(trial_info.get('Trial End', 0) / 100 * 3)
-            event_start = 0
-            for e in range(len(events)):
-                try:
-                    event_end = events[e + 1].frame - events[0].frame
-                except IndexError:
-                    event_end = trial_frames
-
-                if invert_rl == INVERT_RESPONSE:
-                    response = events[e].inverted_response()
-                else:
-                    response = events[e].response
-
-                accuracy = compute_accuracy(data['Target Side'], response)
-
-                for frame in range(event_start, event_end):
-                    data.update({
-                        'Time': '{:.2f}'.format(frame2ms(frame, frame_rate)),
-                        'Time Centered': '{:.2f}'.format(frame2ms(frame, frame_rate) - critical_onset_rounded),
-                        'Response': response,
-                        'Accuracy': accuracy
-                    })
-                    writer.writerow(data)
-                event_start = event_end
+        values = (s['Number'], months, sex, trial_order_name, trial_number,
+                  prescreen_reasons.get(trial_number, ''), l_image, trial_info.get('Center Image', ''), r_image,
+                  target_side, inversion, trial_info.get('Condition', ''))
+
+        # same arithmetic as frame2ms, so that times are formatted identically
+        time = np.arange(len(series.accuracy)) * 1000 / frame_rate
+        yield values, time, time - critical_onset_rounded, series.runs
+
+
+def long_csv(s: Subject, invert_rl):
+    """Generate the CSV text of a long format export (without a header), one trial at a time.
+
+    Rather than writing a row at a time, the fields which are the same for every row of an event are rendered to
+    CSV once, each distinct time is formatted once (the same times recur in every trial), and the rows for a trial
+    are built with a single string formatting operation.  The output is identical to writing one row per frame
+    with csv.DictWriter.
+    :param s: subject object
+    :param invert_rl: controls which L-R elements get inverted
+    """
+    import numpy as np
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect='excel')
+
+    def render(values):
+        # CSV for a partial row (without the line terminator), escaped for use in a %-format template
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()[:-len(writer.dialect.lineterminator)].replace('%', '%%')
+
+    trials = [trial for trial in long_trials(s, invert_rl) if trial[3]]
+    if not trials:
+        return
+
+    # time and time centered for every row, interleaved to match the order of the fields
+    times = np.concatenate([np.column_stack((time, time_centered)).ravel() for _, time, time_centered, _ in trials])
+    # compare bit patterns, so that 0.0 and -0.0 are formatted separately
+    distinct, index = np.unique(times.view(np.int64), return_inverse=True)
+    formatted = np.array(['{:.2f}'.format(t) for t in distinct.view(np.float64).tolist()], dtype=object)
+    formatted = formatted[index.ravel()].tolist()
+
+    start = 0
+    for values, time, time_centered, events in trials:
+        prefix = render(values) + ',%s,%s,'
+        template = ''.join((prefix + render((response, accuracy)) + writer.dialect.lineterminator) * n
+                           for n, response, accuracy in events)
+        end = start + 2 * len(time)
+        yield template % tuple(formatted[start:end])
+        start = end
+
+
+def long_table(s: Subject, invert_rl):
+    """Build a long format export as a pyarrow Table.
+    String columns are dictionary-encoded, since each value is repeated for many rows, and times are numbers
+    (rounded to 0.01 ms as in CSV exports) rather than text.
+    :param s: subject object
+    :param invert_rl: controls which L-R elements get inverted
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    trials = list(long_trials(s, invert_rl))
+    # index of the trial (and of the event) for each row
+    trial_rows = np.repeat(np.arange(len(trials)), [len(time) for _, time, _, _ in trials])
+    events = [event for _, _, _, trial_events in trials for event in trial_events]
+    event_rows = np.repeat(np.arange(len(events)), [n for n, _, _ in events])
+
+    def dictionary_column(values, rows):
+        return pa.array([str(v) for v in values], pa.string()).dictionary_encode().take(pa.array(rows))
+
+    columns = {}
+    for i, field in enumerate(LONG_FIELDS[:12]):
+        values = [trial[0][i] for trial in trials]
+        if field == 'Trial Number':
+            columns[field] = pa.array(np.array(values, dtype=np.int32)[trial_rows])
+        elif field == 'Months':
+            columns[field] = pa.array(np.array(values, dtype=np.float64)[trial_rows])
+        else:
+            columns[field] = dictionary_column(values, trial_rows)
+    times = [np.zeros(0)] + [time for _, time, _, _ in trials]
+    time_centered = [np.zeros(0)] + [tc for _, _, tc, _ in trials]
+    columns['Time'] = pa.array(np.round(np.concatenate(times), 2))
+    columns['Time Centered'] = pa.array(np.round(np.concatenate(time_centered), 2))
+    # Accuracy is a string column, since it may be a code ('-' for away, '.' for off) rather than a number
+    columns['Response'] = dictionary_column([response for _, response, _ in events], event_rows)
+    columns['Accuracy'] = dictionary_column([accuracy for _, _, accuracy in events], event_rows)
+    return pa.table(columns)
+
+
+def export_columnar(filename, s: Subject, invert_rl, file_type='parquet'):
+    """Export subject data in long format to a Parquet or Feather file.  Requires pyarrow.
+    :param s: subject object
+    :param filename: full path to the destination file
+    :param invert_rl: controls which L-R elements get inverted in output file
+    :param file_type: 'parquet' or 'feather'
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Exporting to {} requires pyarrow.  Install it with "pip install pyarrow".'.format(
+            file_type.capitalize()))
+
+    table = long_table(s, invert_rl)
+    if file_type == 'parquet':
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, filename)
+    elif file_type == 'feather':
+        import pyarrow.feather
+        pyarrow.feather.write_feather(table, filename)
+    else:
+        raise ValueError('Unknown file type: {}'.format(file_type))
 
 
 def export_wide(filename, s: Subject, invert_rl, file_mode='w'):
@@ -170,11 +342,27 @@ def export_wide(filename, s: Subject, invert_rl, file_mode='w'):
     :param invert_rl: controls which L-R elements get inverted in output file
     :param file_mode: mode used to open the output file.  Defaults to 'w'
     """
-    columns = ['Sub Num', 'Months', 'Sex', 'Order', 'Tr Num', 'Prescreen Notes',
-               'L-image', 'C-image', 'R-image', 'Target Side', 'Target Image', 'Inversion', 'Condition',
-               'CritOnset']
+    with open(filename, file_mode, newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=wide_fields(s), dialect='excel')
+        if f.tell() == 0:
+            # no header when appending to an existing export
+            writer.writeheader()
+        writer.writerows(wide_rows(s, invert_rl))
 
-    frame_rate = round(s['Framerate'])
+
+def _trial_frames(s: Subject):
+    """Number of frames coded for each trial"""
+    return {t: events[-1].frame - events[0].frame for t, events in s.events.trials().items()}
+
+
+def _wide_layout(s: Subject, frame_rate):
+    """Return the number of frames before critical onset in a wide format export, and the names of the frame
+    columns.  Cached on the subject (see trial_series).
+    """
+    cache = _subject_cache(s)
+    key = ('wide layout', frame_rate)
+    if key in cache:
+        return cache[key]
 
     # remaining columns are for each frame
     # ...
@@ -188,74 +376,169 @@ def export_wide(filename, s: Subject, invert_rl, file_mode='w'):
     if trial_cof:
         max_pre_onset = max([cof for t, cof in trial_cof])
         # number of frames coded for each trial
-        trial_frames = {t: events[-1].frame - events[0].frame for t, events in s.events.trials().items()}
+        trial_frames = _trial_frames(s)
         # frames after critical onset coded for each trial
         post_onset_frames = [trial_frames.get(t, 0) - cof for t, cof in trial_cof]
         max_post_onset = max(post_onset_frames)
 
         frame_columns = ['F{:.0f}'.format(frame2ms(f - max_pre_onset, frame_rate)) for f in range(max_pre_onset + max_post_onset)]
     else:
+        max_pre_onset = 0
         frame_columns = []
 
-    fields = columns + frame_columns
+    cache[key] = max_pre_onset, frame_columns
+    return cache[key]
 
-    with open(filename, file_mode, newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=fields, dialect='excel')
-        writer.writeheader()
 
-        trial_events = s.events.trials()
-        unused = s.trial_order.unused + s.reasons.unused()
-        prescreen_reasons = s.reasons.unused_reasons()
-        for trial_info in s.trial_order.data:
-            trial_number = trial_info['Trial Number']
-            if trial_number in unused:
-                continue
-            critical_onset_rounded = frame2ms(ms2frames(trial_info['Critical Onset'], frame_rate), frame_rate)
-            events = trial_events.get(trial_number, [])
-
-            if invert_rl == INVERT_TRIAL_ORDER:
-                target_side = trial_info.inverted_target()
-                l_image = trial_info['Right Image']
-                r_image = trial_info['Left Image']
+def wide_fields(s: Subject):
+    """Fields of a wide format export: fixed columns followed by a column for each frame"""
+    max_pre_onset, frame_columns = _wide_layout(s, round(s['Framerate']))
+    return list(WIDE_FIELDS) + frame_columns
+
+
+def wide_rows(s: Subject, invert_rl):
+    """Generate rows of a wide format export (one row per trial)
+    :param s: subject object
+    :param invert_rl: controls which L-R elements get inverted
+    """
+    frame_rate = round(s['Framerate'])
+    max_pre_onset, frame_columns = _wide_layout(s, frame_rate)
+    unused = s.trial_order.unused + s.reasons.unused()
+    prescreen_reasons = s.reasons.unused_reasons()
+    for trial_info, series in zip(s.trial_order.data, trial_series(s, invert_rl)):
+        trial_number = trial_info['Trial Number']
+        if trial_number in unused:
+            continue
+
+        if invert_rl == INVERT_TRIAL_ORDER:
+            target_side = trial_info.inverted_target()
+            l_image = trial_info['Right Image']
+            r_image = trial_info['Left Image']
+        else:
+            target_side = trial_info['Target Side']
+            l_image = trial_info['Left Image']
+            r_image = trial_info['Right Image']
+
+        target_image = l_image if target_side == 'L' else r_image
+
+        data = {
+            'Sub Num': s['Number'],
+            'Months': '{:0.1f}'.format(subject_age_months(s)),
+            'Sex': s.get_sex_display(),
+            'Order': s.trial_order.name(),
+            'Tr Num': trial_number,
+            'Prescreen Notes': prescreen_reasons.get(trial_number, ''),
+            'L-image': l_image,
+            'C-image': trial_info['Center Image'],
+            'R-image': r_image,
+            'Target Side': target_side,
+            'Target Image': target_image,
+            'Inversion': INVERSION[invert_rl],
+            'Condition': trial_info['Condition'],
+            'CritOnset': trial_info['Critical Onset']
+        }
+
+        # Coded frames of the trial, aligned so that critical onset falls in the F0 column
+        first_column = max_pre_onset - ms2frames(trial_info['Critical Onset'], frame_rate)
+        data.update(zip(frame_columns[first_column:first_column + series.coded],
+                        series.accuracy[:series.coded].tolist()))
+        yield data
+
+
+def frame_column_ms(column):
+    """Time relative to critical onset (in ms) of a wide format frame column, e.g., 'F-33' -> -33"""
+    return int(column[1:])
+
+
+def combine_fields(field_lists, format='long'):
+    """Fields of a combined export of several subjects, given the fields of the export of each subject.
+    For wide format exports, the frame columns are the union of the frame columns for each subject, in time order.
+    """
+    if format == 'long':
+        return LONG_FIELDS
+    frame_columns = set()
+    for fields in field_lists:
+        frame_columns.update(fields[len(WIDE_FIELDS):])
+    return list(WIDE_FIELDS) + sorted(frame_columns, key=frame_column_ms)
+
+
+# Bulk export.  These functions load a data file and export it in one step, so that the work of exporting many
+# files can be spread over a pool of worker processes.
+
+# Sections of a data file needed to compute the columns of a wide format export
+WIDE_FIELDS_SECTIONS = ('Framerate', 'Responses', 'Trial Order')
+
+
+def load_export_subject(filename, sections=EXPORT_SECTIONS):
+    """Load the parts of a data file needed to export it"""
+    s = Subject()
+    s.from_datafile(filename, sections=sections)
+    return s
+
+
+def datafile_fields(filename, format='long'):
+    """Fields of the export of a data file, loading only the parts of the file needed to compute them"""
+    if format == 'long':
+        return LONG_FIELDS
+    return wide_fields(load_export_subject(filename, WIDE_FIELDS_SECTIONS))
+
+
+def export_datafile(filename, output_filename, format='long', invert_rl=INVERT_TRIAL_ORDER, file_type='csv'):
+    """Export a data file to a .csv (or columnar) file
+    :return: output_filename
+    """
+    export(output_filename, load_export_subject(filename), format=format, invert_rl=invert_rl, file_type=file_type)
+    return output_filename
+
+
+def export_datafile_csv(filename, format='long', invert_rl=INVERT_TRIAL_ORDER, fields=None):
+    """Export a data file to CSV text, without a header, for merging into a combined .csv file
+    :param fields: columns of the combined file (see combine_fields).  Defaults to the columns for this file.
+    :return: CSV text
+    """
+    s = load_export_subject(filename)
+    if format == 'long':
+        return ''.join(long_csv(s, invert_rl))
+    f = io.StringIO()
+    writer = csv.DictWriter(f, fieldnames=fields or wide_fields(s), dialect='excel', restval='')
+    writer.writerows(wide_rows(s, invert_rl))
+    return f.getvalue()
+
+
+def export_combined(output_filename, filenames, format='long', invert_rl=INVERT_TRIAL_ORDER, run_jobs=pool.run_jobs):
+    """Export data files to a single .csv file with one header, in the order of the filenames.
+    Files are exported in parallel by run_jobs (see pool.run_jobs), and written to the combined file as they finish.
+    For wide format, a first pass finds the columns needed for all of the files, loading only the parts of each file
+    needed to compute its columns.
+    :param run_jobs: function(func, jobs) which generates (index, result, error) for each job in order, e.g.
+        pool.run_jobs with progress reporting.  If it stops early, the export is treated as cancelled.
+    :return: list of (filename, error message) for files which could not be exported, or None if cancelled
+    """
+    failures = []
+    if format == 'wide':
+        field_lists = []
+        n = 0
+        for n, (index, field_list, error) in enumerate(run_jobs(datafile_fields, [(f, format) for f in filenames]), 1):
+            if error:
+                failures.append((filenames[index], error))
+            else:
+                field_lists.append((index, field_list))
+        if n < len(filenames):
+            return None
+        filenames = [filenames[index] for index, _ in field_lists]
+        fields = combine_fields((field_list for _, field_list in field_lists), format)
+    else:
+        fields = combine_fields([], format)
+
+    with open(output_filename, 'w', newline='') as f:
+        csv.writer(f, dialect='excel').writerow(fields)
+        n = 0
+        jobs = [(filename, format, invert_rl, fields) for filename in filenames]
+        for n, (index, text, error) in enumerate(run_jobs(export_datafile_csv, jobs), 1):
+            if error:
+                failures.append((filenames[index], error))
             else:
-                target_side = trial_info['Target Side']
-                l_image = trial_info['Left Image']
-                r_image = trial_info['Right Image']
-
-            target_image = l_image if target_side == 'L' else r_image
-
-            data = {
-                'Sub Num': s['Number'],
-                'Months': '{:0.1f}'.format(age_months(s['Birthday'], s['Date of Test'])),
-                'Sex': s.get_sex_display(),
-                'Order': s.trial_order.name(),
-                'Tr Num': trial_number,
-                'Prescreen Notes': prescreen_reasons.get(trial_number, ''),
-                'L-image': l_image,
-                'C-image': trial_info['Center Image'],
-                'R-image': r_image,
-                'Target Side': target_side,
-                'Target Image': target_image,
-                'Inversion': INVERSION[invert_rl],
-                'Condition': trial_info['Condition'],
-                'CritOnset': trial_info['Critical Onset']
-            }
-
-            event_start = 0
-            for e in range(len(events)):
-                try:
-                    event_end = events[e + 1].frame - events[0].frame
-                except IndexError:
-                    event_end = trial_frames.get(trial_number, 0)
-
-                if invert_rl == INVERT_RESPONSE:
-                    response = events[e].inverted_response()
-                else:
-                    response = events[e].response
-                accuracy = compute_accuracy(data['Target Side'], response)
-
-                for frame in range(event_start, event_end):
-                    frame_ms = frame2ms(frame, frame_rate) - critical_onset_rounded
-                    data['F{:.0f}'.format(frame_ms)] = accuracy
-                event_start = event_end
-            writer.writerow(data)
+                f.write(text)
+    if n < len(filenames):
+        return None
+    return failures
@@ -1,22 +1,214 @@
 # Utilities for working with data and template files
 
+import binascii
+import datetime
+import os
 import plistlib
+import shutil
+import tempfile
+from xml.etree.ElementTree import iterparse
 
+from peyecoder.profiling import profiler, profiled
 
-def load_datafile(filename):
-    """Load a data file and return the contents as a dictionary """
+
+# Data files are stored either as XML plists (the format used by iCoder) or in a binary container.
+#
+# The binary container holds the same dictionary as the XML plist, {root: {section: value, ...}}, with each
+# section stored as a separate binary plist so that sections can be read without parsing the rest of the file:
+#   8 bytes   BINARY_MAGIC
+#   4 bytes   length of the index (big-endian)
+#   index     binary plist: {'Root': root, 'Sections': {section: [offset, length], ...}}, offsets from start of file
+#   sections  binary plists
+BINARY_MAGIC = b'PEYEVCX1'
+
+
+def is_binary_datafile(filename):
+    """Check whether a data file uses the binary container format"""
+    with open(filename, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+@profiled('load_datafile')
+def load_datafile(filename, sections=None, item_hooks=None):
+    """Load a data file and return the contents as a dictionary
+    :param filename: Name of the data file
+    :param sections: If given, load only these keys of the subject dictionary.  Other sections are skipped
+        without being converted to python objects (and, for binary data files, without being read).
+    :param item_hooks: Dictionary mapping a path of keys, e.g. ('Subject', 'Responses'), to a function which is
+        applied to each value of the dictionary at that path.  XML data files are parsed incrementally, so each
+        value is converted as soon as it has been read.
+    """
+    item_hooks = item_hooks or {}
+    profiler.add_bytes('load_datafile', os.path.getsize(filename))
     with open(filename, 'rb') as f:
-        data = plistlib.load(f)
+        header = f.read(len(BINARY_MAGIC))
+        if header == BINARY_MAGIC:
+            data = _load_binary(f, sections)
+        elif header.startswith(b'bplist'):
+            f.seek(0)
+            data = plistlib.load(f)
+            if sections is not None:
+                data = {root: {k: v for k, v in d.items() if k in sections} for root, d in data.items()}
+        else:
+            f.seek(0)
+            return _iterparse_plist(f, sections, item_hooks)
+
+    for path, hook in item_hooks.items():
+        d = data
+        try:
+            for key in path:
+                d = d[key]
+        except KeyError:
+            continue
+        for key in d:
+            d[key] = hook(d[key])
     return data
 
 
-def save_datafile(filename, data):
-    """Save data to a datafile"""
+def _load_binary(f, sections):
+    index_length = int.from_bytes(f.read(4), 'big')
+    index = plistlib.loads(f.read(index_length))
+    d = {}
+    for section, (offset, length) in index['Sections'].items():
+        if sections is None or section in sections:
+            f.seek(offset)
+            d[section] = plistlib.loads(f.read(length))
+    return {index['Root']: d}
+
+
+def _plist_integer(text):
+    return int(text, 16) if text.lower().startswith('0x') else int(text)
+
+
+# Conversions from the text of XML plist elements to python values, as in plistlib
+_PLIST_SCALARS = {
+    'string': lambda text: text,
+    'integer': _plist_integer,
+    'real': float,
+    'true': lambda text: True,
+    'false': lambda text: False,
+    'date': lambda text: datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ'),
+    'data': lambda text: binascii.a2b_base64(text.encode('utf-8')),
+}
+
+
+def _iterparse_plist(f, sections, item_hooks):
+    """Parse an XML plist incrementally, discarding each XML element once its value has been stored.
+    See load_datafile for a description of the parameters.
+    """
+    root = None
+    elements = []  # stack of open XML elements
+    containers = []  # stack of (dict or list, path, pending key) for open dict and array elements
+    skip_depth = 0  # depth of nested elements within a section which is not being loaded
+
+    for event, elem in iterparse(f, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            elements.append(elem)
+            if skip_depth:
+                skip_depth += 1
+            elif containers and sections is not None and len(containers[-1][1]) == 1 and \
+                    isinstance(containers[-1][0], dict) and tag != 'key' and containers[-1][2] not in sections:
+                skip_depth = 1
+            elif tag in ('dict', 'array'):
+                if containers:
+                    parent, parent_path, key = containers[-1]
+                    path = parent_path + (key,) if isinstance(parent, dict) else parent_path + (None,)
+                else:
+                    path = ()
+                containers.append(({} if tag == 'dict' else [], path, None))
+            continue
+
+        # end of an element
+        elements.pop()
+        if skip_depth:
+            skip_depth -= 1
+            if skip_depth == 0 and elements:
+                elements[-1].clear()
+            continue
+
+        if tag == 'key':
+            container, path, key = containers[-1]
+            containers[-1] = (container, path, elem.text or '')
+        elif tag == 'plist':
+            pass
+        else:
+            if tag in ('dict', 'array'):
+                value = containers.pop()[0]
+            else:
+                value = _PLIST_SCALARS[tag](elem.text or '')
+
+            if containers:
+                container, path, key = containers[-1]
+                if path in item_hooks:
+                    value = item_hooks[path](value)
+                if isinstance(container, dict):
+                    container[key] = value
+                else:
+                    container.append(value)
+            else:
+                root = value
+
+        # Children of the parent element have all been processed, so they can be released
+        if elements:
+            elements[-1].clear()
+    return root
+
+
+def _dump_binary(data, f):
+    (root, d), = data.items()
+    chunks = [(section, plistlib.dumps(value, fmt=plistlib.FMT_BINARY)) for section, value in d.items()]
+
+    # The size of the index depends on the offsets it contains, so build it with a provisional start offset
+    # and rebuild until the offsets are consistent with the size of the index.
+    start = 0
+    while True:
+        offsets = {}
+        offset = start
+        for section, chunk in chunks:
+            offsets[section] = [offset, len(chunk)]
+            offset += len(chunk)
+        index = plistlib.dumps({'Root': root, 'Sections': offsets}, fmt=plistlib.FMT_BINARY)
+        if start == len(BINARY_MAGIC) + 4 + len(index):
+            break
+        start = len(BINARY_MAGIC) + 4 + len(index)
+
+    f.write(BINARY_MAGIC)
+    f.write(len(index).to_bytes(4, 'big'))
+    f.write(index)
+    for section, chunk in chunks:
+        f.write(chunk)
+
+
+def save_datafile(filename, data, binary=False):
+    """Save data to a datafile
+    The data is written to a temporary file which then replaces the datafile, so that a failure part way through
+    saving does not destroy the existing datafile.
+    :param filename: Name of the data file
+    :param data: Dictionary to be saved, e.g. as returned by Subject.to_plist()
+    :param binary: Save using the binary container format instead of an XML plist
+    """
+    tmp_filename = None
     try:
-        with open(filename, 'wb') as f:
-            plistlib.dump(data, f)
+        fd, tmp_filename = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+        with os.fdopen(fd, 'wb') as f:
+            if binary:
+                _dump_binary(data, f)
+            else:
+                plistlib.dump(data, f)
+        # mkstemp creates a file readable only by the owner; use the permissions a new file would normally have
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp_filename)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_filename, 0o666 & ~umask)
+        os.replace(tmp_filename, filename)
         return True
-    except:
+    except Exception as e:
+        print('Unable to save {}: {}'.format(filename, e))
+        if tmp_filename and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
         return False
 
 
@@ -2,6 +2,9 @@ import sys
 import time
 import math
 
+# Time at which peyecoder started loading, used for the startup report (see StartupTimer)
+STARTUP_T0 = time.perf_counter()
+
 from PySide2 import QtCore, QtWidgets, QtGui
 from PySide2.QtWidgets import QLabel, QPushButton, QSlider, QStyle, \
     QHBoxLayout, QVBoxLayout, QSizePolicy, QAction, QGridLayout, QDialog, \
@@ -14,16 +17,57 @@ import os
 import sys
 from functools import partial
 
-from peyecoder.video_reader import BufferedVideoReader
 from peyecoder.audio_player import VideoAudioPlayer
 from peyecoder.panels import Prescreen, Code, LogTable
 from peyecoder.models import Subject, Occluders
-from peyecoder.file_utils import load_datafile, save_datafile, intify_keys
+from peyecoder.file_utils import load_datafile, save_datafile, intify_keys, is_binary_datafile
+from peyecoder.journal import EditJournal, replay
 from peyecoder.dialogs import SubjectDialog, TimecodeDialog, OccluderDialog, SettingsDialog, CodeComparisonDialog, \
-    ReportDialog, ExportDialog, get_save_filename, ReplaceDialog
+    ReportDialog, ExportDialog, get_save_filename_and_filter, ReplaceDialog
 from peyecoder.reliability import reliability_report
+from peyecoder.latency import latency
+from peyecoder.history import AddEvent, DeleteEvents, ChangeTrials, Resynchronize, AddReason, DeleteReason, \
+    ChangeReasonTrial, CompoundCommand, LOG_INSERT, LOG_DELETE, LOG_UPDATE
 from peyecoder import version
 
+# File types of the Save As dialog for data files (binary data files are smaller and faster to load)
+DATAFILE_FILTER = 'Data Files (*.vcx)'
+BINARY_DATAFILE_FILTER = 'Binary Data Files (*.vcx)'
+
+
+class StartupTimer:
+    """Record the time taken by each stage of starting peyecoder.
+
+    Set the environment variable PEYECODER_STARTUP_REPORT to 1 to print a report to stderr once the main window
+    has been shown, or to a filename to append the report to that file (to track startup times over time).
+    """
+    def __init__(self, t0):
+        self.t = t0
+        self.stages = []
+
+    def mark(self, stage):
+        """Record the end of a stage of startup"""
+        t = time.perf_counter()
+        self.stages.append((stage, (t - self.t) * 1000))
+        self.t = t
+
+    def report(self):
+        destination = os.environ.get('PEYECODER_STARTUP_REPORT', '')
+        if not destination:
+            return
+        total = sum(ms for stage, ms in self.stages)
+        text = 'peyecoder {} startup: {:.0f} ms ({})'.format(
+            version, total, ', '.join('{} {:.0f} ms'.format(stage, ms) for stage, ms in self.stages))
+        if destination == '1':
+            print(text, file=sys.stderr)
+        else:
+            with open(destination, 'a') as f:
+                f.write('{} {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), text))
+
+
+startup_timer = StartupTimer(STARTUP_T0)
+startup_timer.mark('imports')
+
 STATE_PLAYING = 1
 STATE_PAUSED = 2
 
@@ -38,6 +82,13 @@ class JumpSlider(QSlider):
     """
     clicked = Signal(int)
 
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.highlights = []  # (start, end) ranges of values drawn as a timeline under the slider handle
+        self.markers = []  # values drawn as tick marks
+        self.columns = None  # pixel columns of the highlights and markers (see highlight_columns)
+        self.columns_key = None  # width and range of the slider for which the columns were computed
+
     def mousePressEvent(self, ev):
         """ Jump to click position """
         v = QStyle.sliderValueFromPosition(self.minimum(), self.maximum(), ev.x(), self.width())
@@ -45,6 +96,63 @@ class JumpSlider(QSlider):
         super().mousePressEvent(ev)
         self.clicked.emit(v)
 
+    def set_highlights(self, highlights, markers=()):
+        """ Show ranges of values (e.g., frames where coders disagree) and individual values (e.g., events)
+        :param highlights: list of (start, end) ranges, with exclusive end values
+        :param markers: list of values
+        """
+        self.highlights = highlights
+        self.markers = markers
+        self.columns = None
+        self.update()
+
+    def highlight_columns(self):
+        """Return the pixel columns to draw: (left, width) spans for the highlights, merged where they overlap, and
+        x positions of the markers.  There can be many more ranges and markers than pixels, so they are only
+        converted to pixels when they change or the slider is resized, rather than on every repaint.
+        """
+        key = (self.width(), self.minimum(), self.maximum())
+        if self.columns is None or self.columns_key != key:
+            def x(value):
+                return QStyle.sliderPositionFromValue(self.minimum(), self.maximum(), value, self.width())
+
+            spans = []
+            for start, end in sorted(self.highlights):
+                left = x(start)
+                right = max(left + 1, x(end))
+                if spans and left <= spans[-1][1]:
+                    spans[-1][1] = max(spans[-1][1], right)
+                else:
+                    spans.append([left, right])
+            self.columns = ([(left, right - left) for left, right in spans],
+                            sorted(set(x(value) for value in self.markers)))
+            self.columns_key = key
+        return self.columns
+
+    def paintEvent(self, ev):
+        super().paintEvent(ev)
+        if not (self.highlights or self.markers) or self.maximum() <= self.minimum():
+            return
+
+        spans, positions = self.highlight_columns()
+        painter = QtGui.QPainter(self)
+        height = self.height()
+        painter.setPen(QtGui.QColor(0, 0, 255, 160))
+        for position in positions:
+            painter.drawLine(position, height * 3 // 4, position, height - 1)
+        color = QtGui.QColor(255, 0, 0, 160)
+        for left, width in spans:
+            painter.fillRect(left, 0, width, height // 4, color)
+        painter.end()
+
+
+class FrameLabel(QLabel):
+    """ Label displaying frames of video, which reports when a frame has been painted (see LatencyRecorder) """
+    def paintEvent(self, ev):
+        with latency.stage('paint'):
+            super().paintEvent(ev)
+        latency.frame_shown()
+
 
 class MainEventFilter(QObject):
     def eventFilter(self, obj, event):
@@ -68,9 +176,25 @@ class MainWindow(QtWidgets.QMainWindow):
         self.frame_delay = 0  # ms delay between frames when playing video (or maybe use framerate)
         self.state = STATE_PAUSED
 
-        self.image_frame = QLabel()
+        self.image_frame = FrameLabel()
         self.image_frame.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
 
+        # Requests to show the current frame are handled once per iteration of the event loop (see show_frame)
+        self.frame_pending = False
+        # The last frame presented, with occluders drawn, and its scaled pixmap, so that the frame is only composed
+        # and scaled again if the frame, occluders or size of the window change
+        self.composed_frame = None  # (frame, occluders, image)
+        self.scaled_frame = None  # (image, size, pixmap)
+
+        # Latency statistics, shown over the video when requested
+        self.latency_overlay = QLabel(self.image_frame)
+        self.latency_overlay.setStyleSheet('background-color: rgba(0, 0, 0, 160); color: white; '
+                                           'font-family: monospace; padding: 4px;')
+        self.latency_overlay.hide()
+        self.latency_timer = QtCore.QTimer(self)
+        self.latency_timer.setInterval(500)
+        self.latency_timer.timeout.connect(self.update_latency_overlay)
+
         self.occluder_dialog = None
         self.subject_dialog = None
         self.settings_dialog = None
@@ -137,6 +261,7 @@ class MainWindow(QtWidgets.QMainWindow):
         splitter2.splitterMoved.connect(self.splitter_moved)
 
         self.setCentralWidget(splitter2)
+        startup_timer.mark('widgets')
 
         # Use event filter to cause mouse clicks away from the log table to
         # clear the selection (removes focus to fix key handling)
@@ -146,6 +271,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.build_menu()
 
         self.reset_state()
+        startup_timer.mark('reset state')
 
         # If a filename has been passed as a command line argument, try to open it
         if len(argv) > 1:
@@ -168,6 +294,9 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def closeEvent(self, event):
         if self.prompt_save():
+            self.discard_journal()
+            if latency.log_filename and latency.records:
+                latency.dump(latency.log_filename)
             event.accept()
         else:
             event.ignore()
@@ -202,8 +331,10 @@ class MainWindow(QtWidgets.QMainWindow):
         if not self.prompt_save():
             return
 
+        self.discard_journal()
         self.subject = Subject(self)
         self.filename = ''
+        self.binary_datafile = False  # save in the same format as the data file that was opened
         self.setWindowTitle('peyecoder')
         # reset video source
         self.video_source = ''
@@ -213,6 +344,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.audio = VideoAudioPlayer(self)
         self.audio_muted = False
         self.image_frame.clear()
+        self.composed_frame = None
+        self.scaled_frame = None
 
         # reset dialogs
         if self.occluder_dialog:
@@ -227,6 +360,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.subject_dialog = None
         self.settings_dialog = None
         self.code_comparison_dialog = None
+        self.position_slider.set_highlights([])
 
         self.load_defaults()
 
@@ -382,17 +516,90 @@ class MainWindow(QtWidgets.QMainWindow):
         elif self.active_tab == TAB_CODE:
             self.logtable.set_code_labels()
             self.logtable.load_data(self.subject.events.render(self.subject.timecode_offsets, self.timecode))
-
-            errors, err_msg = self.subject.events.error_items(self.subject.trial_order.unused + self.subject.reasons.unused(),
-                                                              self.subject.trial_order.max_trial)
-            self.logtable.redden_rows(errors)
-            self.message_box.setText('\n'.join(err_msg))
+            self.update_code_errors()
         if preserve_highlight:
             self.logtable.itemSelectionChanged.disconnect(self.select_code_row)
             self.logtable.select_rows(rows)
 
             self.logtable.itemSelectionChanged.connect(self.select_code_row)
 
+    def update_code_errors(self):
+        """Highlight rows of the code log containing errors and display the error messages"""
+        errors, err_msg = self.subject.events.error_items(self.subject.trial_order.unused + self.subject.reasons.unused(),
+                                                          self.subject.trial_order.max_trial)
+        self.logtable.redden_rows(errors)
+        self.message_box.setText('\n'.join(err_msg))
+
+    def update_log_rows(self, changes):
+        """Apply changes to individual rows of the code log, as returned when applying or reverting a command.
+        Falls back to rebuilding the log if changes is None.
+        """
+        if changes is None:
+            self.update_log(preserve_highlight=True)
+            return
+        if self.active_tab != TAB_CODE:
+            return  # the log is displaying prescreen reasons, which have not changed
+
+        # Prevent changes to the selection from moving the video
+        self.logtable.itemSelectionChanged.disconnect(self.select_code_row)
+        for action, row in changes:
+            if action == LOG_INSERT:
+                event = self.subject.events[row]
+                self.logtable.insert_entry(row, self.subject.events.render_event(
+                    event, self.subject.timecode_offsets, self.timecode))
+            elif action == LOG_DELETE:
+                self.logtable.remove_entry(row)
+            elif action == LOG_UPDATE:
+                event = self.subject.events[row]
+                self.logtable.update_entry(row, self.subject.events.render_event(
+                    event, self.subject.timecode_offsets, self.timecode))
+        self.logtable.itemSelectionChanged.connect(self.select_code_row)
+
+        self.logtable.unredden_all()
+        self.update_code_errors()
+
+    def apply_command(self, command):
+        """Apply an undoable edit to the subject and update the log, returning the changes to the code log"""
+        latency.begin('edit')
+        changes = self.subject.do(command)
+        with latency.stage('log'):
+            self.update_log_rows(changes)
+            self.update_info_panel()
+            self.update_comparison(command.frames())
+        latency.end(self.vid.frame_number if self.vid else None)
+        return changes
+
+    def undo(self):
+        if self.subject.history.can_undo():
+            command = self.subject.history.undo_stack[-1]
+            self.show_undo_changes(self.subject.undo())
+            self.update_comparison(command.frames())
+
+    def redo(self):
+        if self.subject.history.can_redo():
+            command = self.subject.history.redo_stack[-1]
+            self.show_undo_changes(self.subject.redo())
+            self.update_comparison(command.frames())
+
+    def update_comparison(self, frames=None):
+        """Update the frames where the subject disagrees with the coding in the comparison dialog, and show them on
+        the position slider along with the events of that coding.
+        :param frames: Frame numbers of edited events, or None if any events may have changed
+        """
+        dialog = self.code_comparison_dialog
+        if dialog and dialog.disagreements:
+            dialog.disagreements.update(frames)
+            self.position_slider.set_highlights(dialog.disagreements.intervals, dialog.frames)
+
+    def show_undo_changes(self, changes):
+        self.update_log_rows(changes)
+        self.update_info_panel()
+        # Scroll to the first affected row so that the change is visible
+        if changes and self.active_tab == TAB_CODE:
+            row = min(min(row for action, row in changes), self.logtable.rowCount() - 1)
+            if row >= 0:
+                self.logtable.scroll_to_row(row)
+
     def select_code_row(self):
         """ When a row or rows have been selected in the code log, update the code tab widgets and the video position
         to correspond to the first selected row.
@@ -412,33 +619,22 @@ class MainWindow(QtWidgets.QMainWindow):
                     self.code_comparison_dialog.scroll_to_frame(self.subject.events[row].frame)
 
     def add_reason(self, reason):
-        self.subject.reasons.add_reason(reason, ps=self.prescreen_tab.group_who.checkedId())
-        self.update_log()
-        self.update_info_panel()
-        self.subject.dirty = True
+        self.apply_command(AddReason(reason, ps=self.prescreen_tab.group_who.checkedId()))
 
     def add_event(self, event):
         event.frame = self.vid.frame_number
-        self.subject.events.add_event(event)
-        self.update_log(preserve_highlight=True)
+        changes = self.apply_command(AddEvent(event))
         # Scroll to the newly-added item
-        row = self.subject.events.absolute_index(event)
-        self.logtable.scroll_to_row(row)
-        self.subject.dirty = True
+        self.logtable.scroll_to_row(changes[0][1])
 
     def delete_data_rows(self, rows):
         """Delete rows from events or reasons as appropriate """
         if self.active_tab == TAB_PRESCREEN:  # Prescreen
             # delete prescreen reasons by trial
             ps = self.prescreen_tab.prescreener()
-            for row in rows:
-                trial = int(rows[row])
-                self.subject.reasons.delete_reason(trial, ps)
+            self.apply_command(CompoundCommand(DeleteReason(int(rows[row]), ps) for row in rows))
         elif self.active_tab == TAB_CODE:  # Code
-            # delete code entries by row (in descending order)
-            for row in reversed(sorted(rows)):
-                self.subject.events.delete_event(row)
-        self.subject.dirty = True
+            self.apply_command(DeleteEvents(self.subject.events[row] for row in rows))
 
     def build_menu(self):
         """Create the menu bar and global fixed actions"""
@@ -520,6 +716,20 @@ class MainWindow(QtWidgets.QMainWindow):
         about_box_action.setMenuRole(QAction.NoRole)
         about_box_action.triggered.connect(self.show_about_box)
 
+        record_latency_action = QAction('Record Latency', self)
+        record_latency_action.setStatusTip('Record the time taken to respond to keys and display frames')
+        record_latency_action.setCheckable(True)
+        record_latency_action.setChecked(latency.enabled)
+        record_latency_action.toggled.connect(self.record_latency)
+
+        show_latency_action = QAction('Show Latency Statistics', self)
+        show_latency_action.setCheckable(True)
+        show_latency_action.toggled.connect(self.show_latency)
+
+        save_latency_action = QAction('Save Latency Log...', self)
+        save_latency_action.setStatusTip('Append the recorded latencies to a CSV file')
+        save_latency_action.triggered.connect(self.save_latency)
+
         export_action = QAction('E&xport CSV', self)
         export_action.setShortcut('Ctrl+e')
         export_action.setStatusTip('Export CSV')
@@ -558,6 +768,16 @@ class MainWindow(QtWidgets.QMainWindow):
         self.open_settings_action.setMenuRole(QAction.NoRole)
         self.open_settings_action.triggered.connect(self.open_settings_dialog)
 
+        self.undo_action = QAction('&Undo', self)
+        self.undo_action.setShortcut(QtGui.QKeySequence.Undo)
+        self.undo_action.setStatusTip('Undo the last edit')
+        self.undo_action.triggered.connect(self.undo)
+
+        self.redo_action = QAction('Re&do', self)
+        self.redo_action.setShortcut(QtGui.QKeySequence.Redo)
+        self.redo_action.setStatusTip('Redo the last undone edit')
+        self.redo_action.triggered.connect(self.redo)
+
         self.open_replace_action = QAction('&Replace Responses', self)
         self.open_replace_action.setStatusTip('Find/Replace Responses')
         self.open_replace_action.triggered.connect(self.open_replace_dialog)
@@ -578,6 +798,9 @@ class MainWindow(QtWidgets.QMainWindow):
         file_menu.addAction(exit_action)
 
         edit_menu = menu_bar.addMenu('&Edit')
+        edit_menu.addAction(self.undo_action)
+        edit_menu.addAction(self.redo_action)
+        edit_menu.addSeparator()
         edit_menu.addAction(self.open_subject_action)
         edit_menu.addAction(self.open_occluders_action)
         edit_menu.addAction(self.open_settings_action)
@@ -600,6 +823,32 @@ class MainWindow(QtWidgets.QMainWindow):
         help_menu = menu_bar.addMenu('&Help')
         help_menu.addAction(help_url_action)
         help_menu.addAction(about_box_action)
+        help_menu.addSeparator()
+        help_menu.addAction(record_latency_action)
+        help_menu.addAction(show_latency_action)
+        help_menu.addAction(save_latency_action)
+
+    def record_latency(self, checked):
+        latency.enabled = checked
+
+    def show_latency(self, checked):
+        if checked:
+            self.update_latency_overlay()
+            self.latency_overlay.show()
+            self.latency_timer.start()
+        else:
+            self.latency_timer.stop()
+            self.latency_overlay.hide()
+
+    def update_latency_overlay(self):
+        self.latency_overlay.setText(latency.stats_text())
+        self.latency_overlay.adjustSize()
+
+    def save_latency(self):
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Latency Log', filter='CSV Files (*.csv)')
+        if filename:
+            latency.dump(filename)
+            latency.clear()
 
     def open_help_url(self):
         target = 'https://rholson1.github.io/peyecoder/'
@@ -622,74 +871,78 @@ class MainWindow(QtWidgets.QMainWindow):
         # Prompt user to enter a new timestamp for the current frame
         new_frame_number = self.get_timecode_frames()
         if new_frame_number:
-            self.subject.timecode_offsets[self.vid.frame_number] = new_frame_number - self.vid.frame_number
+            # applying the command updates the log table so that timestamps are correct
+            self.apply_command(Resynchronize(self.vid.frame_number, new_frame_number - self.vid.frame_number))
             self.update_timecode()
-            # update log table so that timestamps are correct
-            self.update_log()
 
     def keyPressEvent(self, event: QtGui.QKeyEvent):
         super().keyPressEvent(event)
         self.handle_keypress(event)
 
     def handle_keypress(self, e):
-        if e.matches(QtGui.QKeySequence.Copy):
-            self.logtable.copy_selection()
-        if e.key() == Qt.Key_Right:
-            self.next_frame()
-        elif e.key() == Qt.Key_Left:
-            self.prev_frame()
-        elif e.key() == Qt.Key_Up:
-            # forward up/down keypresses to the log table
-            self.logtable.keyPressEvent(e)
-        elif e.key() == Qt.Key_Down:
-            # forward up/down keypresses to the log table
-            self.logtable.keyPressEvent(e)
-        elif e.key() == Qt.Key_BracketLeft:
-            self.prev_step()
-        elif e.key() == Qt.Key_BracketRight:
-            self.next_step()
-        elif e.key() == Qt.Key_Space:
-            self.toggle_state()
-        elif e.key() in (Qt.Key_Plus, Qt.Key_Equal):
-            if e.modifiers() & Qt.AltModifier:
-                if self.logtable.has_selection():
-                    self.change_selected_trials(1)
-            else:
-                self.change_trial(1)
-        elif e.key() == Qt.Key_Minus:
-            if e.modifiers() & Qt.AltModifier:
-                if self.logtable.has_selection():
-                    self.change_selected_trials(-1)
-            else:
-                self.change_trial(-1)
-        elif e.key() in (Qt.Key_Enter, Qt.Key_Return):
-            if self.active_tab == TAB_PRESCREEN:
-                self.prescreen_tab.record_reason()
-            else:
-                self.code_tab.record_event()
-        elif e.key() in (Qt.Key_Delete, Qt.Key_Backspace):
-            # The order of operations is important here
-            selected_rows = self.logtable.selected_rows()
-            next_row = max(selected_rows) - len(selected_rows) + 1  # identify the row after the last row to be deleted
-            self.logtable.delete_selected()
-            self.delete_data_rows(selected_rows)
-            self.update_log()  # necessary only to update row highlighting if error status has changed
-
-            # Disconnect self.select_code_row before highlighting next row -- don't want to change position in video
-            self.logtable.itemSelectionChanged.disconnect(self.select_code_row)
-            self.logtable.select_rows([next_row])  # highlight the row after the last deleted row
-            self.logtable.itemSelectionChanged.connect(self.select_code_row)
-            self.update_info_panel()
-        elif e.key() == self.subject.settings.get('Toggle Trial Status Key', None):
-            # toggle between 0 and 1
-            self.code_tab.trial_status.setCurrentIndex(not self.code_tab.trial_status.currentIndex())
-        elif e.key() in self.subject.settings.get('Response Keys', {}):
-            self.code_tab.response_box.setCurrentText(self.subject.settings['Response Keys'][e.key()])
-
-        # Clear the log table when pressing a key that results in changing the position in the video
-        # if e.key() in (Qt.Key_Right, Qt.Key_Left, Qt.Key_BracketLeft, Qt.Key_BracketRight, Qt.Key_Space):
-        #    self.logtable.clearSelection()
-        #    self.logtable.setCurrentIndex(QtCore.QModelIndex())  # clear current index within logtable
+        latency.begin(lambda: 'key ' + QtGui.QKeySequence(e.key()).toString())
+        try:
+            if e.matches(QtGui.QKeySequence.Copy):
+                self.logtable.copy_selection()
+            if e.key() == Qt.Key_Right:
+                self.next_frame()
+            elif e.key() == Qt.Key_Left:
+                self.prev_frame()
+            elif e.key() == Qt.Key_Up:
+                # forward up/down keypresses to the log table
+                self.logtable.keyPressEvent(e)
+            elif e.key() == Qt.Key_Down:
+                # forward up/down keypresses to the log table
+                self.logtable.keyPressEvent(e)
+            elif e.key() == Qt.Key_BracketLeft:
+                self.prev_step()
+            elif e.key() == Qt.Key_BracketRight:
+                self.next_step()
+            elif e.key() == Qt.Key_Space:
+                self.toggle_state()
+            elif e.key() in (Qt.Key_Plus, Qt.Key_Equal):
+                if e.modifiers() & Qt.AltModifier:
+                    if self.logtable.has_selection():
+                        self.change_selected_trials(1)
+                else:
+                    self.change_trial(1)
+            elif e.key() == Qt.Key_Minus:
+                if e.modifiers() & Qt.AltModifier:
+                    if self.logtable.has_selection():
+                        self.change_selected_trials(-1)
+                else:
+                    self.change_trial(-1)
+            elif e.key() in (Qt.Key_Enter, Qt.Key_Return):
+                if self.active_tab == TAB_PRESCREEN:
+                    self.prescreen_tab.record_reason()
+                else:
+                    self.code_tab.record_event()
+            elif e.key() in (Qt.Key_Delete, Qt.Key_Backspace):
+                # The order of operations is important here
+                selected_rows = self.logtable.selected_rows()
+                if not selected_rows:
+                    return
+                # identify the row after the last row to be deleted
+                next_row = max(selected_rows) - len(selected_rows) + 1
+                self.delete_data_rows(selected_rows)
+
+                # Disconnect self.select_code_row before highlighting next row -- don't want to change position in video
+                self.logtable.itemSelectionChanged.disconnect(self.select_code_row)
+                self.logtable.clearSelection()
+                self.logtable.select_rows([next_row])  # highlight the row after the last deleted row
+                self.logtable.itemSelectionChanged.connect(self.select_code_row)
+            elif e.key() == self.subject.settings.get('Toggle Trial Status Key', None):
+                # toggle between 0 and 1
+                self.code_tab.trial_status.setCurrentIndex(not self.code_tab.trial_status.currentIndex())
+            elif e.key() in self.subject.settings.get('Response Keys', {}):
+                self.code_tab.response_box.setCurrentText(self.subject.settings['Response Keys'][e.key()])
+
+            # Clear the log table when pressing a key that results in changing the position in the video
+            # if e.key() in (Qt.Key_Right, Qt.Key_Left, Qt.Key_BracketLeft, Qt.Key_BracketRight, Qt.Key_Space):
+            #    self.logtable.clearSelection()
+            #    self.logtable.setCurrentIndex(QtCore.QModelIndex())  # clear current index within logtable
+        finally:
+            latency.end(self.vid.frame_number if self.vid else None)
 
     def change_selected_trials(self, delta):
         rows = self.logtable.selected_rows()
@@ -700,14 +953,10 @@ class MainWindow(QtWidgets.QMainWindow):
 
         if self.active_tab == TAB_PRESCREEN:
             # get the trial number from the log table
-            for r in rows:
-                trial = self.logtable.data[r][0]
-                self.subject.reasons.change_trial(trial, delta, self.prescreen_tab.prescreener())
+            ps = self.prescreen_tab.prescreener()
+            self.apply_command(CompoundCommand(ChangeReasonTrial(self.logtable.data[r][0], delta, ps) for r in rows))
         elif self.active_tab == TAB_CODE:
-            for r in rows:
-                self.subject.events.change_trial(r, delta)
-        self.update_log(preserve_highlight=True)
-        self.update_info_panel()
+            self.apply_command(ChangeTrials([self.subject.events[r] for r in rows], delta))
 
     def change_trial(self, delta):
         if self.active_tab == TAB_PRESCREEN:
@@ -750,12 +999,14 @@ class MainWindow(QtWidgets.QMainWindow):
 
         if self.state == STATE_PLAYING:
             self.toggle_state()
-        if offset > 0:
-            self.vid.next(offset)
-        elif offset < 0:
-            self.vid.prev(-offset)  # note minus sign!
-        self.update_position(self.vid.frame_number)
-        self.show_frame()
+        latency.begin(lambda: 'step {:+d}'.format(offset))
+        with latency.stage('decode'):
+            if offset > 0:
+                self.vid.next(offset)
+            elif offset < 0:
+                self.vid.prev(-offset)  # note minus sign!
+        self.update_position(self.vid.frame_number)  # also shows the frame
+        latency.end(self.vid.frame_number)
 
     def next_frame(self):
         # Advance to next frame of video
@@ -774,32 +1025,68 @@ class MainWindow(QtWidgets.QMainWindow):
         self.change_frame(-self.subject.settings['Step'])
 
     def show_frame(self):
-        """ Display the current frame of video"""
+        """ Display the current frame of video.
+        The frame is presented once control returns to the event loop, so that several requests to show a frame
+        while handling one input (e.g., moving to a frame and updating the position slider) are handled once.
+        """
         if not self.vid:
             return
+        latency.expect_frame()
+        if not self.frame_pending:
+            self.frame_pending = True
+            QtCore.QTimer.singleShot(0, self.present_frame)
+
+    def present_frame(self):
+        """ Draw the current frame of video, with occluders, scaled to fit the window """
+        self.frame_pending = False
+        if not self.vid:
+            latency.frame_shown()
+            return
 
         frame = self.vid.frame
-        h, w, d = frame.shape
-        bytes_per_line = w * d
-        image = QtGui.QImage(frame.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888)
-
-        # Draw occluders in image
-        painter = QtGui.QPainter(image)
-        for occluder in self.subject.occluders:
-            painter.fillRect(occluder, QtCore.Qt.gray)
-        painter.end()
-
-        # rescale image to fit window, keeping aspect ratio unchanged
-        image_scaled = image.scaled(self.image_frame.width(), self.image_frame.height(),
-                                    QtCore.Qt.KeepAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation)
-
-        self.image_frame.setPixmap(QtGui.QPixmap.fromImage(image_scaled))
-
-        self.image_frame.repaint()
+        occluders = tuple(self.subject.occluders)
+        if self.composed_frame and self.composed_frame[0] is frame and self.composed_frame[1] == occluders:
+            image = self.composed_frame[2]
+        else:
+            with latency.stage('convert'):
+                h, w, d = frame.shape
+                bytes_per_line = w * d
+                image = QtGui.QImage(frame.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888)
+
+            # Draw occluders in image
+            with latency.stage('occluders'):
+                painter = QtGui.QPainter(image)
+                for occluder in occluders:
+                    painter.fillRect(QtCore.QRect(*occluder), QtCore.Qt.gray)
+                painter.end()
+            # the image uses the memory of the frame, so keep a reference to the frame
+            self.composed_frame = (frame, occluders, image)
+
+        size = (self.image_frame.width(), self.image_frame.height())
+        if self.scaled_frame and self.scaled_frame[0] is image and self.scaled_frame[1] == size:
+            pixmap = self.scaled_frame[2]
+        else:
+            # rescale image to fit window, keeping aspect ratio unchanged
+            with latency.stage('scale'):
+                image_scaled = image.scaled(size[0], size[1], QtCore.Qt.KeepAspectRatio,
+                                            QtCore.Qt.TransformationMode.SmoothTransformation)
+            with latency.stage('pixmap'):
+                pixmap = QtGui.QPixmap.fromImage(image_scaled)
+            self.scaled_frame = (image, size, pixmap)
+
+        self.image_frame.setPixmap(pixmap)
+        if self.image_frame.isVisible():
+            # schedule painting the frame, which ends the measurement of latency (see FrameLabel)
+            self.image_frame.update()
+        else:
+            latency.frame_shown()
 
     def initialize_video(self):
         # Actions to perform when a new video has been loaded
+        # OpenCV is slow to import, so defer importing it until a video is opened
+        from peyecoder.video_reader import BufferedVideoReader
         self.vid = BufferedVideoReader(self.video_source)
+        latency.set_video(self.video_source, self.vid.fourcc, self.vid.width, self.vid.height, self.vid.frame_rate)
 
         # Create timecode object
         framerate_string = '{:.2f}'.format(self.vid.frame_rate).replace('.00', '')
@@ -823,7 +1110,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.subject.set_framerate(self.vid.frame_rate)
 
         # prompt for starting timecode
-        self.subject.timecode_offsets[0] = self.get_timecode_frames()
+        self.subject.set_timecode_offset(0, self.get_timecode_frames())
         self.update_timecode()
 
     def get_timecode_frames(self):
@@ -842,7 +1129,8 @@ class MainWindow(QtWidgets.QMainWindow):
             self.video_source = filename
 
             self.initialize_video()
-            self.subject.events.remove_offset(self.subject.timecode_offsets.get_offset(0))
+            self.subject.remove_offset(self.subject.timecode_offsets.get_offset(0))
+            self.update_comparison()
             av_error = ''
             try:
                 self.audio.set_video_source(self.video_source, self.vid.frame_rate)
@@ -865,9 +1153,13 @@ class MainWindow(QtWidgets.QMainWindow):
     def open_data_file(self, filename):
         if filename != '':
             self.reset_state()
-            self.subject.from_plist(load_datafile(filename))
+            self.subject.from_datafile(filename)
             if self.vid:
-                self.subject.events.remove_offset(self.subject.timecode_offsets.get_offset(0))
+                self.subject.remove_offset(self.subject.timecode_offsets.get_offset(0))
+            self.recover_journal(filename)
+            self.subject.journal = self.new_journal(filename)
+            # recovered edits are in the journal, so they can be undone and redone by replaying it
+            self.subject.journal.commands.update(self.subject.history.undo_stack + self.subject.history.redo_stack)
 
             # update timecode so stored framerate used to render timecodes (if a video is not loaded)
             framerate_string = '{:.2f}'.format(self.subject['Framerate']).replace('.00', '')
@@ -879,25 +1171,72 @@ class MainWindow(QtWidgets.QMainWindow):
             if self.subject_dialog:
                 self.subject_dialog.update_from_dict(self.subject.to_dict())
             self.filename = filename
+            self.binary_datafile = is_binary_datafile(filename)
             self.setWindowTitle('peyecoder - {}'.format(os.path.basename(filename)))
             self.code_tab.set_responses(list(self.subject.settings['Response Keys'].values()))
 
     def save_datafile(self):
         if self.filename:
-            if save_datafile(self.filename, self.subject.to_plist()):
+            if save_datafile(self.filename, self.subject.to_plist(), binary=self.binary_datafile):
                 self.subject.dirty = False
+                # edits in the journal are now in the data file
+                self.restart_journal(self.filename)
         else:
             self.save_as_datafile()
         return not self.subject.dirty
 
     def save_as_datafile(self):
-        filename = get_save_filename(self, "Save Data File", filter="Data Files (*.vcx)", default_suffix='vcx')
+        filters = [DATAFILE_FILTER, BINARY_DATAFILE_FILTER]
+        filename, selected_filter = get_save_filename_and_filter(
+            self, "Save Data File", filter=';;'.join(filters), default_suffix='vcx',
+            selected_filter=filters[self.binary_datafile])
         if filename != '':
-            if save_datafile(filename, self.subject.to_plist()):
+            binary = selected_filter == BINARY_DATAFILE_FILTER
+            if save_datafile(filename, self.subject.to_plist(), binary=binary):
                 self.subject.dirty = False
+                self.binary_datafile = binary
+                self.restart_journal(filename)
             self.filename = filename
             self.setWindowTitle('peyecoder - {}'.format(os.path.basename(filename)))
 
+    def recover_journal(self, filename):
+        """Offer to restore edits which were journaled but never saved to a data file (e.g., due to a crash)"""
+        if not EditJournal.exists(filename):
+            return
+        ret = QMessageBox.question(self, 'peyecoder', ('{} has unsaved changes from a previous session.  '
+                                                       'Do you want to recover them?').format(os.path.basename(filename)),
+                                   QMessageBox.Yes | QMessageBox.No, defaultButton=QMessageBox.Yes)
+        if ret == QMessageBox.Yes:
+            try:
+                replay(self.subject, EditJournal.read(filename))
+            except Exception as e:
+                QMessageBox.warning(self, 'peyecoder', 'Some changes could not be recovered: {}'.format(e),
+                                    QMessageBox.Ok)
+        else:
+            EditJournal(filename).clear()
+
+    def restart_journal(self, filename):
+        """Journal further edits to a data file after saving it, deleting the earlier journal.
+        The undo history is kept (see Subject.undo for how undoing edits made before saving is journaled).
+        """
+        self.discard_journal()
+        self.subject.journal = self.new_journal(filename)
+
+    def new_journal(self, filename):
+        return EditJournal(filename, on_error=self.journal_error)
+
+    def journal_error(self, e):
+        """Warn (once) that edits are no longer journaled because the journal can't be written"""
+        QMessageBox.warning(self, 'peyecoder', ('Unable to write the journal of unsaved changes ({}).  Changes made '
+                                                'from now on can only be kept by saving the data file.').format(e),
+                            QMessageBox.Ok)
+
+    def discard_journal(self):
+        """Stop journaling edits to the current subject, deleting the journal"""
+        if self.subject.journal:
+            self.subject.journal.clear()
+            self.subject.journal = None
+
     def export_csv(self):
         """Open the export csv dialog"""
         export_dialog = ExportDialog(self)
@@ -916,6 +1255,8 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 self.code_comparison_dialog = CodeComparisonDialog(self, filename)
             self.code_comparison_dialog.show()
+            self.code_comparison_dialog.compare(self.subject)
+            self.update_comparison([])
 
             report = reliability_report(self.subject, self.code_comparison_dialog.subject, self.timecode)
             text = '\n'.join(report)
@@ -943,9 +1284,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def play(self):
         t0 = time.perf_counter()
-        self.vid.next()
-        self.update_position(self.vid.frame_number)
-        self.show_frame()
+        latency.begin('play')
+        with latency.stage('decode'):
+            self.vid.next()
+        self.update_position(self.vid.frame_number)  # also shows the frame
+        latency.end(self.vid.frame_number)
         if self.state == STATE_PLAYING:
             delay = self.frame_delay - (time.perf_counter() - t0) * 1000
             QtCore.QTimer.singleShot(max(math.floor(delay), 0), self.play)
@@ -986,25 +1329,32 @@ class MainWindow(QtWidgets.QMainWindow):
         self.timecode_label.setText(str(self.timecode))
 
     def update_position(self, position):
-        self.position_slider.setValue(position)
+        with latency.stage('controls'):
+            self.position_slider.setValue(position)
         self.setPosition(position)
 
     def durationChanged(self, duration):
         self.position_slider.setRange(0, duration - 1)
 
     def setPosition(self, position):
-        self.vid.goto_framenumber(position)
+        latency.begin('seek')
+        with latency.stage('decode'):
+            self.vid.goto_framenumber(position)
         try:
-            self.audio.seek(position)
+            with latency.stage('controls'):
+                self.audio.seek(position)
         except:
             QMessageBox.warning(self, 'peyecoder', ('Unable to seek to the requested position in the audio.'
                                                     ' This likely means that an incorrect timecode was entered '
                                                     'when the video was opened.  Reload video and enter correct '
                                                     'starting timestamp.'), QMessageBox.Ok)
-            self.subject.events.reset_offset()
+            self.subject.reset_offset()
+            self.update_comparison()
 
-        self.update_timecode()
+        with latency.stage('controls'):
+            self.update_timecode()
         self.show_frame()
+        latency.end(position)
 
     def resizeEvent(self, event: QtGui.QResizeEvent):
         super().resizeEvent(event)
@@ -1018,8 +1368,15 @@ class MainWindow(QtWidgets.QMainWindow):
 def run(argv):
     """Run peyecoder application"""
     app = QtWidgets.QApplication([])
+    startup_timer.mark('QApplication')
     widget = MainWindow(argv)
     widget.resize(800, 600)
     widget.show()
+    startup_timer.mark('show')
+
+    def window_shown():
+        startup_timer.mark('first event loop iteration')
+        startup_timer.report()
+    QtCore.QTimer.singleShot(0, window_shown)
     return app.exec_()
 
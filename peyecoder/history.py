@@ -0,0 +1,404 @@
+# Undo/redo support for edits to a Subject
+
+# Changes to the code log reported by commands, as (action, row) pairs
+LOG_INSERT = 1
+LOG_DELETE = 2
+LOG_UPDATE = 3
+
+
+class Command:
+    """A reversible edit to a Subject.
+
+    Commands store only the data needed to apply and revert a single edit, rather than a copy of the subject.
+    apply() and revert() return a list of (action, row) changes to the rows of the code log, or None if the edit
+    does not map onto individual rows (in which case the whole log should be refreshed).
+    """
+    def apply(self, subject):
+        raise NotImplementedError
+
+    def revert(self, subject):
+        raise NotImplementedError
+
+    def frames(self):
+        """Return the frame numbers of the events added, deleted or changed by the command (e.g., to update a
+        comparison with another coding session), or None if they are unknown.
+        """
+        return None
+
+    def to_dict(self):
+        """Return a JSON-serializable description of the command, used to journal edits.
+        Must be called before the command is applied, since events are identified by their current values.
+        """
+        raise NotImplementedError
+
+    def inverse(self):
+        """Return a command which has the same effect as reverting this command, once it has been applied.
+        Used to journal undoing a command which is not in the journal.
+        """
+        raise NotImplementedError
+
+
+class CompoundCommand(Command):
+    """A group of commands which are applied and reverted together"""
+    def __init__(self, commands):
+        self.commands = list(commands)
+
+    def apply(self, subject):
+        done = []
+        changes = []
+        try:
+            for command in self.commands:
+                changes = _merge_changes(changes, command.apply(subject))
+                done.append(command)
+        except Exception:
+            # leave the subject unchanged if any part of the edit fails
+            for command in reversed(done):
+                command.revert(subject)
+            raise
+        return changes
+
+    def revert(self, subject):
+        changes = []
+        for command in reversed(self.commands):
+            changes = _merge_changes(changes, command.revert(subject))
+        return changes
+
+    def frames(self):
+        frames = []
+        for command in self.commands:
+            command_frames = command.frames()
+            if command_frames is None:
+                return None
+            frames.extend(command_frames)
+        return frames
+
+    def to_dict(self):
+        return {'Command': 'Compound', 'Commands': [c.to_dict() for c in self.commands]}
+
+    def inverse(self):
+        return CompoundCommand(c.inverse() for c in reversed(self.commands))
+
+
+def _merge_changes(changes, new_changes):
+    if changes is None or new_changes is None:
+        return None
+    return changes + new_changes
+
+
+def _event_key(event):
+    return [event.frame, event._status, event.trial, event.response]
+
+
+def _find_events(subject, keys):
+    """Find distinct events matching each of a list of keys returned by _event_key"""
+    found = []
+    for key in keys:
+        index = subject.events.find_event(*key)
+        if index is None:
+            raise ValueError('No event matching {}'.format(key))
+        # skip over identical events which have already been matched
+        while any(subject.events[index] is e for e in found):
+            index += 1
+            if index == len(subject.events) or _event_key(subject.events[index]) != key:
+                raise ValueError('No event matching {}'.format(key))
+        found.append(subject.events[index])
+    return found
+
+
+class AddEvent(Command):
+    def __init__(self, event):
+        self.event = event
+
+    def apply(self, subject):
+        return [(LOG_INSERT, subject.events.add_event(self.event))]
+
+    def revert(self, subject):
+        row = subject.events.position(self.event)
+        subject.events.delete_event(row)
+        return [(LOG_DELETE, row)]
+
+    def frames(self):
+        return [self.event.frame]
+
+    def to_dict(self):
+        return {'Command': 'AddEvent', 'Event': _event_key(self.event)}
+
+    def inverse(self):
+        return DeleteEvents([self.event])
+
+
+class DeleteEvents(Command):
+    def __init__(self, events):
+        """
+        :param events: Event objects (taken from subject.events) to be deleted
+        """
+        self.events = list(events)
+
+    def apply(self, subject):
+        rows = sorted((subject.events.position(e) for e in self.events), reverse=True)
+        for row in rows:
+            subject.events.delete_event(row)
+        return [(LOG_DELETE, row) for row in rows]
+
+    def revert(self, subject):
+        return [(LOG_INSERT, subject.events.add_event(e)) for e in self.events]
+
+    def frames(self):
+        return [e.frame for e in self.events]
+
+    def to_dict(self):
+        return {'Command': 'DeleteEvents', 'Events': [_event_key(e) for e in self.events]}
+
+    def inverse(self):
+        return CompoundCommand(AddEvent(e) for e in self.events)
+
+
+class ChangeTrials(Command):
+    def __init__(self, events, delta):
+        """
+        :param events: Event objects (taken from subject.events) to be renumbered
+        :param delta: Change in trial number
+        """
+        self.events = list(events)
+        self.delta = delta
+
+    def _change(self, subject, delta):
+        changes = []
+        for event in self.events:
+            row = subject.events.position(event)
+            subject.events.change_trial(row, delta)
+            changes.append((LOG_UPDATE, row))
+        return changes
+
+    def apply(self, subject):
+        return self._change(subject, self.delta)
+
+    def revert(self, subject):
+        return self._change(subject, -self.delta)
+
+    def frames(self):
+        return []  # responses are unchanged
+
+    def to_dict(self):
+        return {'Command': 'ChangeTrials', 'Events': [_event_key(e) for e in self.events], 'Delta': self.delta}
+
+    def inverse(self):
+        return ChangeTrials(self.events, -self.delta)
+
+
+class ReplaceResponses(Command):
+    def __init__(self, replacements):
+        """
+        :param replacements: list of (event, old response, new response)
+        """
+        self.replacements = list(replacements)
+
+    def _replace(self, subject, new):
+        changes = []
+        for event, old_response, new_response in self.replacements:
+            event.response = new_response if new else old_response
+            changes.append((LOG_UPDATE, subject.events.position(event)))
+        subject.events.invalidate()
+        return changes
+
+    def apply(self, subject):
+        return self._replace(subject, True)
+
+    def revert(self, subject):
+        return self._replace(subject, False)
+
+    def frames(self):
+        return [e.frame for e, old, new in self.replacements]
+
+    def to_dict(self):
+        return {'Command': 'ReplaceResponses',
+                'Replacements': [[_event_key(e), old, new] for e, old, new in self.replacements]}
+
+    def inverse(self):
+        return ReplaceResponses((e, new, old) for e, old, new in self.replacements)
+
+
+class Resynchronize(Command):
+    def __init__(self, frame, offset):
+        """
+        :param frame: Frame number at which the timecode offset starts
+        :param offset: New timecode offset, or None to remove the offset at frame
+        """
+        self.frame = frame
+        self.offset = offset
+        self.old_offset = None
+
+    def apply(self, subject):
+        self.old_offset = subject.timecode_offsets.get(self.frame)
+        if self.offset is None:
+            subject.timecode_offsets.pop(self.frame, None)
+        else:
+            subject.timecode_offsets[self.frame] = self.offset
+        return None  # timecodes change for every later row
+
+    def revert(self, subject):
+        if self.old_offset is None:
+            del subject.timecode_offsets[self.frame]
+        else:
+            subject.timecode_offsets[self.frame] = self.old_offset
+        return None
+
+    def frames(self):
+        return []  # only timecodes change
+
+    def to_dict(self):
+        return {'Command': 'Resynchronize', 'Frame': self.frame, 'Offset': self.offset}
+
+    def inverse(self):
+        return Resynchronize(self.frame, self.old_offset)
+
+
+class AddReason(Command):
+    def __init__(self, reason, ps):
+        self.reason = reason
+        self.ps = ps
+        self.old_reason = None
+
+    def apply(self, subject):
+        self.old_reason = subject.reasons.ps[self.ps - 1].get(self.reason.trial)
+        subject.reasons.add_reason(self.reason, self.ps)
+        return None
+
+    def revert(self, subject):
+        if self.old_reason is None:
+            subject.reasons.delete_reason(self.reason.trial, self.ps)
+        else:
+            subject.reasons.add_reason(self.old_reason, self.ps)
+        return None
+
+    def frames(self):
+        return []
+
+    def to_dict(self):
+        return {'Command': 'AddReason', 'Reason': self.reason.values(), 'PS': self.ps}
+
+    def inverse(self):
+        if self.old_reason is None:
+            return DeleteReason(self.reason.trial, self.ps)
+        return AddReason(self.old_reason, self.ps)
+
+
+class DeleteReason(Command):
+    def __init__(self, trial, ps=0):
+        self.trial = trial
+        self.ps = ps
+        self.old_reasons = {}
+
+    def apply(self, subject):
+        prescreeners = (1, 2) if self.ps == 0 else (self.ps,)
+        self.old_reasons = {n: subject.reasons.ps[n - 1][self.trial]
+                            for n in prescreeners if self.trial in subject.reasons.ps[n - 1]}
+        subject.reasons.delete_reason(self.trial, self.ps)
+        return None
+
+    def revert(self, subject):
+        for n, reason in self.old_reasons.items():
+            subject.reasons.add_reason(reason, n)
+        return None
+
+    def frames(self):
+        return []
+
+    def to_dict(self):
+        return {'Command': 'DeleteReason', 'Trial': self.trial, 'PS': self.ps}
+
+    def inverse(self):
+        return CompoundCommand(AddReason(reason, n) for n, reason in self.old_reasons.items())
+
+
+class ChangeReasonTrial(Command):
+    def __init__(self, trial, delta, ps=0):
+        self.trial = trial
+        self.delta = delta
+        self.ps = ps
+
+    def apply(self, subject):
+        subject.reasons.change_trial(self.trial, self.delta, self.ps)
+        return None
+
+    def revert(self, subject):
+        subject.reasons.change_trial(self.trial + self.delta, -self.delta, self.ps)
+        return None
+
+    def frames(self):
+        return []
+
+    def to_dict(self):
+        return {'Command': 'ChangeReasonTrial', 'Trial': self.trial, 'Delta': self.delta, 'PS': self.ps}
+
+    def inverse(self):
+        return ChangeReasonTrial(self.trial + self.delta, -self.delta, self.ps)
+
+
+def command_from_dict(subject, d):
+    """Recreate a command from the output of Command.to_dict(), given the subject in the state in which the
+    command was originally applied.
+    """
+    # imported here because peyecoder.models imports this module
+    from peyecoder.models import Event, Reason
+
+    name = d['Command']
+    if name == 'Compound':
+        return CompoundCommand(command_from_dict(subject, c) for c in d['Commands'])
+    elif name == 'AddEvent':
+        frame, status, trial, response = d['Event']
+        return AddEvent(Event(trial=trial, status=status, response=response, frame=frame))
+    elif name == 'DeleteEvents':
+        return DeleteEvents(_find_events(subject, d['Events']))
+    elif name == 'ChangeTrials':
+        return ChangeTrials(_find_events(subject, d['Events']), d['Delta'])
+    elif name == 'ReplaceResponses':
+        events = _find_events(subject, [key for key, old, new in d['Replacements']])
+        return ReplaceResponses((e, old, new) for e, (key, old, new) in zip(events, d['Replacements']))
+    elif name == 'Resynchronize':
+        return Resynchronize(d['Frame'], d['Offset'])
+    elif name == 'AddReason':
+        return AddReason(Reason(*d['Reason']), d['PS'])
+    elif name == 'DeleteReason':
+        return DeleteReason(d['Trial'], d['PS'])
+    elif name == 'ChangeReasonTrial':
+        return ChangeReasonTrial(d['Trial'], d['Delta'], d['PS'])
+    raise ValueError('Unknown command: {}'.format(name))
+
+
+class EditHistory:
+    """Unbounded undo/redo stacks of commands applied to a subject"""
+    def __init__(self):
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def do(self, subject, command):
+        """Apply a new command.  Any commands which had been undone can no longer be redone."""
+        changes = command.apply(subject)
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+        return changes
+
+    def undo(self, subject):
+        """Revert the most recent command, returning its changes to the code log"""
+        command = self.undo_stack.pop()
+        changes = command.revert(subject)
+        self.redo_stack.append(command)
+        return changes
+
+    def redo(self, subject):
+        """Reapply the most recently undone command, returning its changes to the code log"""
+        command = self.redo_stack.pop()
+        changes = command.apply(subject)
+        self.undo_stack.append(command)
+        return changes
+
+    def can_undo(self):
+        return len(self.undo_stack) > 0
+
+    def can_redo(self):
+        return len(self.redo_stack) > 0
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
@@ -0,0 +1,125 @@
+# Append-only journal of unsaved edits, used to recover work after a crash
+
+import json
+import os
+
+from peyecoder.history import command_from_dict
+from peyecoder.file_utils import intify_keys
+from peyecoder.models import Occluders, TrialOrder
+
+
+def journal_filename(datafile):
+    """Name of the journal file kept next to a data file"""
+    return datafile + '.journal'
+
+
+class EditJournal:
+    """Append-only log of the edits made to a subject since its data file was last saved.
+
+    Each edit is written as a line of JSON and flushed immediately, so recording an edit costs about as much as a
+    small write() call, regardless of the size of the subject.  Saving the data file folds the journaled edits
+    into the data file, after which the journal is cleared.
+
+    If the journal can't be written (e.g., the disk is full or the data file's directory is read-only), journaling
+    stops, so that editing never fails because of the journal.
+    """
+    def __init__(self, datafile, on_error=None):
+        """
+        :param datafile: Name of the data file
+        :param on_error: Function called with the exception if the journal can't be written, e.g. to warn the user.
+            Defaults to printing a message.
+        """
+        self.filename = journal_filename(datafile)
+        self.f = None
+        self.failed = False  # set once writing the journal has failed
+        self.on_error = on_error
+        self.commands = set()  # commands journaled by 'Do' entries, which can be undone and redone by replaying
+
+    def append(self, entry):
+        if self.failed:
+            return
+        try:
+            if self.f is None:
+                self.f = open(self.filename, 'a', encoding='utf-8')
+            self.f.write(json.dumps(entry) + '\n')
+            self.f.flush()
+        except OSError as e:
+            self.failed = True
+            self.close()
+            if self.on_error:
+                self.on_error(e)
+            else:
+                print('Unable to write {}, so edits are no longer journaled: {}'.format(self.filename, e))
+
+    def close(self):
+        if self.f:
+            f = self.f
+            self.f = None
+            try:
+                f.close()
+            except OSError:
+                pass  # every entry has already been flushed, or journaling has failed
+
+    def clear(self):
+        """Discard journaled edits (e.g., because they have been saved to the data file)"""
+        self.close()
+        try:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+        except OSError as e:
+            print('Unable to remove {}: {}'.format(self.filename, e))
+
+    @staticmethod
+    def exists(datafile):
+        """Check for a journal containing edits which were never saved to a data file"""
+        filename = journal_filename(datafile)
+        return os.path.isfile(filename) and os.path.getsize(filename) > 0
+
+    @staticmethod
+    def read(datafile):
+        """Read the entries in the journal for a data file"""
+        entries = []
+        with open(journal_filename(datafile), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # the last entry may be incomplete if peyecoder crashed while writing it
+                    break
+        return entries
+
+
+def replay(subject, entries):
+    """Apply journaled edits to a subject loaded from the corresponding data file.  Replayed edits can be undone."""
+    for entry in entries:
+        edit = entry['Edit']
+        if edit == 'Do':
+            subject.do(command_from_dict(subject, entry['Command']))
+        elif edit == 'Undo':
+            subject.undo()
+        elif edit == 'Redo':
+            subject.redo()
+        elif edit == 'Apply':
+            # undo or redo of an edit made before the data file was saved, which is not in the undo history
+            command_from_dict(subject, entry['Command']).apply(subject)
+            subject.dirty = True
+        elif edit == 'Info':
+            subject.update_from_dict(entry['Fields'])
+            subject.dirty = True
+        elif edit == 'RemoveOffset':
+            subject.remove_offset(entry['Offset'])
+        elif edit == 'ResetOffset':
+            subject.reset_offset()
+        elif edit == 'TimecodeOffset':
+            subject.set_timecode_offset(entry['Frame'], entry['Offset'])
+        elif edit == 'Framerate':
+            subject.set_framerate(entry['Framerate'])
+        elif edit == 'TrialOrder':
+            subject.set_trial_order(TrialOrder.from_plist(entry['Trials']))
+        elif edit == 'Occluders':
+            subject.set_occluders(Occluders.from_dictlist(entry['Occluders']))
+        elif edit == 'Settings':
+            settings = entry['Settings']
+            if 'Response Keys' in settings:
+                settings['Response Keys'] = intify_keys(settings['Response Keys'])
+            subject.update_settings(settings)
@@ -0,0 +1,146 @@
+# Opt-in measurement of the time from an input (e.g., a keypress) to the display of the resulting frame
+
+import csv
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Stages of displaying a frame, in the order in which they happen
+STAGES = ('decode', 'controls', 'convert', 'occluders', 'scale', 'pixmap', 'paint', 'log')
+
+
+class LatencyRecorder:
+    """Record the duration of each stage of responding to inputs, keeping the most recent records in a ring buffer.
+
+    An input is measured from begin() to end(), and stage() measures parts of the response (time spent in a stage
+    more than once, e.g. if a frame is drawn twice, is added up).  If a new frame is to be painted later (see
+    expect_frame()), the measurement continues until frame_shown() is called.  Recording is off unless enabled, in
+    which case begin(), stage() and end() do almost nothing.
+
+    Set the environment variable PEYECODER_LATENCY to 1 to record from startup, or to a filename to also save the
+    records to that file when peyecoder exits.
+    """
+    def __init__(self, capacity=2000):
+        self.records = deque([], capacity)
+        self.enabled = False
+        self.current = None  # record of the input being measured
+        self.depth = 0  # number of nested calls to begin() for the current input
+        self.waiting = False  # the current input has been handled, but its frame has not been painted yet
+        self.frame = None  # frame number to be painted
+        self.video = {}  # properties of the current video (codec, resolution), stored with each record
+        self.log_filename = None
+
+        destination = os.environ.get('PEYECODER_LATENCY', '')
+        if destination:
+            self.enabled = True
+            if destination != '1':
+                self.log_filename = destination
+
+    def set_video(self, filename, fourcc, width, height, frame_rate):
+        self.video = {'video': os.path.basename(filename), 'fourcc': fourcc,
+                      'resolution': '{}x{}'.format(int(width), int(height)), 'fps': round(frame_rate, 3)}
+
+    def begin(self, action):
+        """Start measuring the response to an input.  If an input is already being measured (e.g., a keypress
+        which moves to another frame), calls to begin() and end() are nested within it.
+        :param action: Description of the input, or a function returning it, so that a description which is costly
+            to build (e.g., the name of a key) is only built when recording
+        """
+        if self.current is not None:
+            self.depth += 1
+        elif self.enabled:
+            start = time.perf_counter()
+            self.current = {'action': action() if callable(action) else action, 'start': start, 'stages': {}}
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a stage of the response to the current input"""
+        if self.current is None:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self.current['stages']
+            stages[name] = stages.get(name, 0) + time.perf_counter() - t0
+
+    def end(self, frame=None):
+        """Finish measuring the response to the current input
+        :param frame: Frame number displayed
+        """
+        if self.current is None:
+            return
+        if self.depth:
+            self.depth -= 1
+        elif self.waiting:
+            self.frame = frame
+        else:
+            self._finish(frame)
+
+    def expect_frame(self):
+        """Continue measuring the current input until a frame has been painted"""
+        if self.current is not None:
+            self.waiting = True
+
+    def frame_shown(self):
+        """Finish measuring the current input once the frame it is waiting for has been painted"""
+        if self.waiting:
+            self.waiting = False
+            self.depth = 0
+            self._finish(self.frame)
+
+    def _finish(self, frame):
+        record = self.current
+        self.current = None
+        record['total'] = time.perf_counter() - record['start']
+        record['time'] = time.time()
+        record['frame'] = frame
+        record.update(self.video)
+        self.records.append(record)
+
+    def clear(self):
+        self.records.clear()
+
+    def stats(self):
+        """Summarize the records: {stage or 'total': (count, 50th, 90th, 99th percentile and maximum in ms)}"""
+        samples = {'total': [r['total'] for r in self.records]}
+        for r in self.records:
+            for stage, t in r['stages'].items():
+                samples.setdefault(stage, []).append(t)
+        stats = {}
+        for name in ('total',) + STAGES:
+            values = sorted(samples.get(name, ()))
+            if values:
+                n = len(values)
+                stats[name] = (n,) + tuple(values[min(n - 1, n * p // 100)] * 1000 for p in (50, 90, 99)) + \
+                    (values[-1] * 1000,)
+        return stats
+
+    def stats_text(self):
+        """Render stats() as lines of text, e.g. for display over the video"""
+        lines = ['{} inputs   p50 / p90 / p99 / max ms'.format(len(self.records))]
+        for name, (n, p50, p90, p99, maximum) in self.stats().items():
+            lines.append('{:9} {:6.1f} {:6.1f} {:6.1f} {:6.1f}'.format(name, p50, p90, p99, maximum))
+        if self.video:
+            lines.append('{fourcc} {resolution} {fps} fps'.format(**self.video))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        """Append the records to a CSV file (with a header, if the file is new), one row per input"""
+        fields = ['Time', 'Action', 'Frame', 'Video', 'FourCC', 'Resolution', 'FPS', 'Total (ms)'] + \
+                 ['{} (ms)'.format(stage.capitalize()) for stage in STAGES]
+        with open(filename, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(fields)
+            for r in self.records:
+                writer.writerow([time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['time'])), r['action'],
+                                 r['frame'], r.get('video', ''), r.get('fourcc', ''), r.get('resolution', ''),
+                                 r.get('fps', ''), '{:.3f}'.format(r['total'] * 1000)] +
+                                ['{:.3f}'.format(r['stages'][stage] * 1000) if stage in r['stages'] else ''
+                                 for stage in STAGES])
+
+
+latency = LatencyRecorder()
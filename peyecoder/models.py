@@ -1,17 +1,27 @@
 # Data models for peyecoder
 
-from PySide2.QtCore import QRect, Qt
-
 from sortedcontainers import SortedDict, SortedList
 from functools import total_ordering
-from collections import Counter
+from collections import Counter, namedtuple
 from itertools import groupby, accumulate
 from operator import attrgetter
 
-from timecode import Timecode
 import csv
+import sys
+
+from peyecoder.file_utils import stringify_keys, intify_keys, load_datafile
+from peyecoder.history import EditHistory
+from peyecoder.date_utils import parse_date
+from peyecoder.profiling import profiled
 
-from peyecoder.file_utils import stringify_keys, intify_keys
+# Key codes used for default settings.  These are the values of Qt.Key_1 ... Qt.Key_6, defined here so that the
+# data models can be used without importing Qt.
+KEY_1 = 0x31
+KEY_2 = 0x32
+KEY_3 = 0x33
+KEY_4 = 0x34
+KEY_5 = 0x35
+KEY_6 = 0x36
 
 
 class Subject:
@@ -30,16 +40,19 @@ class Subject:
         self.trial_order = TrialOrder()
         self.settings = {  # Set some default values
             'Step': 10,
-            'Toggle Trial Status Key': int(Qt.Key_6),
+            'Toggle Trial Status Key': KEY_6,
             'Response Keys': {
-                int(Qt.Key_1): 'left',
-                int(Qt.Key_2): 'off',
-                int(Qt.Key_3): 'right',
-                int(Qt.Key_4): 'away',
-                int(Qt.Key_5): 'center'
+                KEY_1: 'left',
+                KEY_2: 'off',
+                KEY_3: 'right',
+                KEY_4: 'away',
+                KEY_5: 'center'
             }
         }
         self.dirty = False  # track existence of unsaved changes
+        self.history = EditHistory()  # undo/redo of edits to events, reasons and timecode offsets
+        self.journal = None  # EditJournal recording unsaved edits, if any
+        self.export_cache = {}  # values derived from events and trial order (see peyecoder.export.trial_series)
         self.parent = parent
 
     def reset(self):
@@ -47,10 +60,96 @@ class Subject:
         self.reasons = Reasons()
         self.events = Events()
         self.trial_order = TrialOrder()
+        self.history.clear()
+        self.export_cache.clear()
+
+    def do(self, command):
+        """Apply an edit (a peyecoder.history.Command) so that it can be undone.
+        Returns a list of (action, row) changes to the code log, or None if the whole log must be refreshed.
+        """
+        entry = {'Edit': 'Do', 'Command': command.to_dict()} if self.journal else None
+        changes = self.history.do(self, command)
+        self.dirty = True
+        if self.journal:
+            self.journal.append(entry)
+            self.journal.commands.add(command)
+        return changes
+
+    def undo(self):
+        """Undo the most recent edit, returning changes to the code log as for do()"""
+        entry = self._history_entry('Undo', self.history.undo_stack)
+        changes = self.history.undo(self)
+        self.dirty = True
+        if entry:
+            self.journal.append(entry)
+        return changes
+
+    def redo(self):
+        """Redo the most recently undone edit, returning changes to the code log as for do()"""
+        entry = self._history_entry('Redo', self.history.redo_stack)
+        changes = self.history.redo(self)
+        self.dirty = True
+        if entry:
+            self.journal.append(entry)
+        return changes
+
+    def _history_entry(self, edit, stack):
+        """Journal entry for undoing or redoing the command at the top of an undo or redo stack.
+        A command applied before the journal was started (i.e., before the data file was last saved) can't be undone
+        or redone when the journal is replayed, so the edit is journaled as a command with the same effect instead.
+        """
+        if not self.journal or not stack:
+            return None
+        command = stack[-1]
+        if command in self.journal.commands:
+            return {'Edit': edit}
+        return {'Edit': 'Apply', 'Command': (command.inverse() if edit == 'Undo' else command).to_dict()}
+
+    def remove_offset(self, offset):
+        """Remove a timecode offset from events imported with timecodes (see Events.remove_offset)"""
+        self.events.remove_offset(offset)
+        if self.journal:
+            self.journal.append({'Edit': 'RemoveOffset', 'Offset': offset})
+
+    def reset_offset(self):
+        """Restore the timecode offset removed by remove_offset (see Events.reset_offset)"""
+        self.events.reset_offset()
+        if self.journal:
+            self.journal.append({'Edit': 'ResetOffset'})
+
+    def set_trial_order(self, trial_order):
+        """Replace the trial order (e.g., with one read from a trial order file)"""
+        self.trial_order = trial_order
+        self.dirty = True
+        if self.journal:
+            self.journal.append({'Edit': 'TrialOrder', 'Trials': trial_order.to_plist()})
+
+    def set_occluders(self, occluders):
+        self.occluders = occluders
+        self.dirty = True
+        if self.journal:
+            self.journal.append({'Edit': 'Occluders', 'Occluders': occluders.to_dictlist()})
+
+    def update_settings(self, settings):
+        """Update some of the coding settings (e.g., 'Step', 'Response Keys')"""
+        self.settings.update(settings)
+        self.dirty = True
+        if self.journal:
+            if 'Response Keys' in settings:
+                settings = dict(settings, **{'Response Keys': stringify_keys(settings['Response Keys'])})
+            self.journal.append({'Edit': 'Settings', 'Settings': settings})
 
     def update_from_dict(self, d):
         for f in self.fieldnames:
             self._d[f] = d.get(f, '')
+        if self.journal:
+            self.journal.append({'Edit': 'Info', 'Fields': self._d})
+
+    def date(self, field):
+        """Return a date field (e.g., 'Birthday') as a datetime.date (parse_date caches the result).
+        Raises ValueError if the date can't be parsed.
+        """
+        return parse_date(self._d.get(field, ''))
 
     def get_sex_display(self):
         sex = self._d.get('Sex', None)
@@ -77,6 +176,14 @@ class Subject:
 
     def set_framerate(self, framerate):
         self._framerate = framerate
+        if self.journal:
+            self.journal.append({'Edit': 'Framerate', 'Framerate': framerate})
+
+    def set_timecode_offset(self, frame, offset):
+        """Set the timecode offset starting at a frame (e.g., the starting timecode of a video, at frame 0)"""
+        self.timecode_offsets[frame] = offset
+        if self.journal:
+            self.journal.append({'Edit': 'TimecodeOffset', 'Frame': frame, 'Offset': offset})
 
     def to_plist(self):
         data = {}
@@ -92,6 +199,15 @@ class Subject:
 
         return {'Subject': data}
 
+    def from_datafile(self, filename, sections=None):
+        """Load subject data from a data file.  Responses are converted to Events as the file is parsed.
+        :param filename: Name of the data file
+        :param sections: If given, load only these sections of the data file (see file_utils.load_datafile)
+        """
+        self.from_plist(load_datafile(filename, sections=sections,
+                                      item_hooks={('Subject', 'Responses'): Events.event_from_plist}))
+
+    @profiled('from_plist')
     def from_plist(self, data):
         d = data['Subject']
         if 'Occluders' in d:
@@ -268,6 +384,9 @@ class Reasons:
 
 @total_ordering
 class Event:
+    # Sessions can hold many thousands of events, so avoid a per-instance __dict__
+    __slots__ = ('trial', '_status', 'response', 'frame', 'has_offset')
+
     def __init__(self, trial=0, status=False, response='', frame=0, has_offset=False):
         """
         Event object
@@ -279,10 +398,12 @@ class Event:
 
         has_offset will only be True for events imported from old iCoder files that specify events using a timecode
         instead of a frame number.
+
+        Response strings are interned, so events sharing a response also share a single string object.
         """
         self.trial = trial
         self._status = status
-        self.response = response
+        self.response = sys.intern(response)
         self.frame = frame
         self.has_offset = has_offset
 
@@ -349,15 +470,55 @@ class Events:
     def __init__(self, events=None):
         self.events = SortedList(events)
         self.removed_offset = 0
+        self._trials = None  # cached result of trials()
+        self.revision = 0  # incremented whenever events change, so that other caches can detect changes
+
+    def invalidate(self):
+        """Discard cached values derived from the list of events.  Call after modifying events in place."""
+        self._trials = None
+        self.revision += 1
 
     def add_event(self, event):
+        """Add an event and return its index in the sorted list of events"""
+        # SortedList.add inserts after any equal events, i.e. at the bisect_right position
+        index = self.events.bisect_right(event)
         self.events.add(event)
+        self.invalidate()
+        return index
 
     def delete_event(self, index):
         self.events.pop(index)
+        self.invalidate()
 
     def change_trial(self, index, delta):
         self.events[index].trial += delta
+        self.invalidate()
+
+    def position(self, event):
+        """Return the index of a particular Event object (not merely an equal one)"""
+        for i in range(self.events.bisect_left(event), len(self.events)):
+            if self.events[i] is event:
+                return i
+        raise ValueError('{} is not in the list of events'.format(event))
+
+    def find_event(self, frame, status, trial, response):
+        """
+        Return the index of the event matching on all fields, or None if there is no such event.
+        :param frame: Frame number
+        :param status: Trial status (True/'on' or False/'off')
+        :param trial: Trial number
+        :param response: Coder's response
+        """
+        status = status in ('on', True)
+        # Events compare equal when frame and status match, so only the events in that range need to be checked
+        start = self.events.bisect_left(Event(status=status, frame=frame))
+        for i in range(start, len(self.events)):
+            event = self.events[i]
+            if event.frame != frame or event._status != status:
+                break
+            if event.trial == trial and event.response == response:
+                return i
+        return None
 
     def render(self, offsets, timecode):
         """
@@ -365,11 +526,13 @@ class Events:
         :param offsets: Offsets object which contains frame offsets used to generate timecodes that match video
         :param timecode: Timecode object (with predefined framerate, drop_frame) used to generate timecode strings
         """
-        data = []
-        for event in self.events:
-            timecode.frames = event.frame + 1 + offsets.get_offset(event.frame)
-            data.append([event.trial, event.status, event.response, str(timecode)])
-        return data
+        return [self.render_event(event, offsets, timecode) for event in self.events]
+
+    @staticmethod
+    def render_event(event, offsets, timecode):
+        """Return a single row of the data returned by render()"""
+        timecode.frames = event.frame + 1 + offsets.get_offset(event.frame)
+        return [event.trial, event.status, event.response, str(timecode)]
 
     def to_plist(self):
         data = {}
@@ -384,33 +547,30 @@ class Events:
 
     @staticmethod
     def from_plist(data, framerate_string='29.97'):
+        """Create Events from the 'Responses' section of a data file.
+        Responses may already have been converted to Events by event_from_plist while the file was loaded.
+        """
+        return Events([e if isinstance(e, Event) else Events.event_from_plist(e, framerate_string)
+                       for e in data.values()])
 
-        timecode = Timecode(framerate_string)
-        timecode.drop_frame = False
-
-        events = []
-        for e in data.values():
-            if 'Timecode' in e:
-                # convert iCoder-style timecode to frame number
-                timecode.set_timecode('{}:{}:{}:{}'.format(
-                    e['Timecode']['Hour'],
-                    e['Timecode']['Minute'],
-                    e['Timecode']['Second'],
-                    e['Timecode']['Frame'])
-                )
-                e['Frame'] = timecode.frames - 1
-                has_offset = True  # by assumption; we don't know if the timecode of the first frame is 00:00:00:00
-            else:
-                has_offset = False
-
-            events.append(
-                Event(trial=e['Trial'],
-                      status=e['Trial Status'] in ('on', True),
-                      response=e['Type'],
-                      frame=e['Frame'],
-                      has_offset=has_offset)
-            )
-        return Events(events)
+    @staticmethod
+    def event_from_plist(e, framerate_string='29.97'):
+        """Convert a single response from a data file to an Event"""
+        if 'Timecode' in e:
+            # convert iCoder-style (non-drop-frame) timecode to frame number
+            tc = e['Timecode']
+            fps = round(float(framerate_string))
+            frame = ((int(tc['Hour']) * 60 + int(tc['Minute'])) * 60 + int(tc['Second'])) * fps + int(tc['Frame'])
+            has_offset = True  # by assumption; we don't know if the timecode of the first frame is 00:00:00:00
+        else:
+            frame = e['Frame']
+            has_offset = False
+
+        return Event(trial=e['Trial'],
+                     status=e['Trial Status'] in ('on', True),
+                     response=e['Type'],
+                     frame=frame,
+                     has_offset=has_offset)
 
     def remove_offset(self, offset):
         """Remove offset from any events having has_offset == True"""
@@ -419,6 +579,7 @@ class Events:
             if event.has_offset:
                 event.frame -= offset
                 event.has_offset = False
+        self.invalidate()
 
     def reset_offset(self):
         """Mark events as having offset to allow recovery from state where the initial timecode was entered incorrectly"""
@@ -426,6 +587,7 @@ class Events:
             event.has_offset = True
             event.frame += self.removed_offset
         self.removed_offset = 0
+        self.invalidate()
 
     def error_items(self, unused_trials, max_trial):
         """ Check for errors and return a list of row numbers (which should be highlighted) and
@@ -509,20 +671,18 @@ class Events:
 
     def absolute_index(self, item):
         # find index of event matching on all fields
-        for i, event in enumerate(self.events):
-            if item.trial == event.trial and \
-                    item._status == event._status and \
-                    item.response == event.response and \
-                    item.frame == event.frame:
-                return i
-        return None
+        return self.find_event(item.frame, item._status, item.trial, item.response)
 
     def __len__(self):
         return len(self.events)
 
     def trials(self):
-        """ Compute trials from the list of events"""
-        return {k: list(g) for k, g in groupby(self.events, attrgetter('trial'))}
+        """ Compute trials from the list of events
+        The result is cached until the events are modified, so callers must not modify the returned lists.
+        """
+        if self._trials is None:
+            self._trials = {k: list(g) for k, g in groupby(self.events, attrgetter('trial'))}
+        return self._trials
 
     def frames(self):
         """ Compute frames with responses from events
@@ -536,6 +696,35 @@ class Events:
         responses[self.events[-1].frame] = self.events[-1].response
         return responses
 
+    def bisect_frame(self, frame):
+        """Return the index of the first event at or after a frame"""
+        # at the same frame, 'on' events sort before 'off' events, so this is the first possible event at the frame
+        return self.events.bisect_left(Event(status=True, frame=frame))
+
+    def intervals(self, start=None, end=None):
+        """ Compute the same responses as frames(), as a list of (start frame, end frame, response) intervals.
+        Each event lasts until the next event (end frames are exclusive), and the last event lasts one frame.
+        Events which last no frames (because the next event has the same frame number) are omitted.
+        :param start, end: If given, only the intervals overlapping frames start to end - 1 are computed (without
+            clipping them), using only the events near that range
+        """
+        if start is None:
+            events = list(self.events)
+            last = True
+        else:
+            # the event before start may last into the range, and the first event at or after end ends the range
+            first = max(0, self.bisect_frame(start) - 1)
+            stop = self.bisect_frame(end) + 1
+            events = list(self.events.islice(first, stop))
+            last = stop >= len(self.events)
+        intervals = [(e.frame, next_e.frame, e.response) for e, next_e in zip(events, events[1:])
+                     if e.frame < next_e.frame]
+        if events and last:
+            intervals.append((events[-1].frame, events[-1].frame + 1, events[-1].response))
+        if start is not None:
+            intervals = [i for i in intervals if i[1] > start and i[0] < end]
+        return intervals
+
 
 class Offsets(SortedDict):
     """Class to store frame offsets for timecodes in a video"""
@@ -556,20 +745,24 @@ class Offsets(SortedDict):
         return Offsets({int(k): v for k, v in data.items()})
 
 
-# Occluders is basically a list of QRect objects
+# Rectangle in video frame pixel coordinates.  Convert to a QRect for drawing with QRect(*rect).
+Rect = namedtuple('Rect', 'x y w h')
+
+
+# Occluders is basically a list of Rect objects
 class Occluders:
     def __init__(self, occluders=None):
         """
-        :param occluders: list of QRect objects
+        :param occluders: list of Rect objects
         """
         self.occluders = occluders if occluders else []
 
     @staticmethod
     def from_dictlist(d):
-        return Occluders([QRect(*[r[x] for x in 'xywh']) for r in d])
+        return Occluders([Rect(*[r[x] for x in 'xywh']) for r in d])
 
     def to_dictlist(self):
-        return [dict(zip('xywh', r.getRect())) for r in self.occluders]
+        return [r._asdict() for r in self.occluders]
 
     def __iter__(self):
         return self.occluders.__iter__()
@@ -185,10 +185,30 @@ class LogTable(QTableWidget):
         # Add a row to the table, given an iterable
         new_row = self.rowCount()
         self.setRowCount(new_row + 1)
+        self._set_row(new_row, entry)
+
+    def _set_row(self, row, entry):
         for col, v in enumerate(entry):
             item = QTableWidgetItem(str(v))
             item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)  # Do not want ItemIsEditable
-            self.setItem(new_row, col, item)
+            self.setItem(row, col, item)
+
+    def insert_entry(self, row, entry):
+        """Insert an entry into the table data and the table at a particular row"""
+        self.data.insert(row, entry)
+        self.insertRow(row)
+        self._set_row(row, entry)
+
+    def remove_entry(self, row):
+        """Remove the entry at a particular row from the table data and the table"""
+        self.data.pop(row)
+        self.removeRow(row)
+
+    def update_entry(self, row, entry):
+        """Replace the entry at a particular row, preserving the selection"""
+        self.data[row] = entry
+        for col, v in enumerate(entry):
+            self.item(row, col).setText(str(v))
 
     def load_data(self, data):
         self.data = data
@@ -206,6 +226,12 @@ class LogTable(QTableWidget):
             for c in range(self.columnCount()):
                 self.item(r, c).setForeground(Qt.red)
 
+    def unredden_all(self):
+        """Restore the default text color of all rows"""
+        for r in range(self.rowCount()):
+            for c in range(self.columnCount()):
+                self.item(r, c).setData(Qt.ForegroundRole, None)
+
     def delete_selected(self):
         """Delete selected rows"""
         deleted_rows = []
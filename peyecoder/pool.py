@@ -0,0 +1,51 @@
+# Running jobs (e.g., exporting data files) on a pool of worker processes, shared by peyecoder-batch and the GUI
+
+from concurrent.futures import ProcessPoolExecutor, wait
+from functools import partial
+
+from peyecoder.profiling import profiler, profiled_call
+
+
+def run_jobs(func, jobs, processes=None, poll=None):
+    """Run func(*args) for each args in jobs on a pool of worker processes.
+    Generates (index, result, error) for each job, in the order of the jobs, where error is None or a message if the
+    job failed (in which case result is None).  If profiling, the measurements of the workers are merged into the
+    profiler of this process.
+    :param processes: Number of worker processes (default: number of CPUs)
+    :param poll: Function called with the number of jobs finished so far, repeatedly while waiting for a job to
+        finish (e.g., to show progress and keep a GUI responsive).  If it returns True, the remaining jobs are
+        cancelled and no more results are generated.
+    """
+    executor = ProcessPoolExecutor(max_workers=processes)
+    futures = []
+    finished = False
+    try:
+        job_function = partial(profiled_call, func) if profiler.enabled else func
+        futures = [executor.submit(job_function, *args) for args in jobs]
+        for index in range(len(futures)):
+            future = futures[index]
+            while poll:
+                if poll(index):
+                    return
+                if future.done():
+                    break
+                wait([future], timeout=0.05)
+            try:
+                result, error = future.result(), None
+                if profiler.enabled:
+                    result, measurements = result
+                    profiler.merge(measurements)
+            except Exception as e:
+                result, error = None, '{}: {}'.format(type(e).__name__, e)
+            futures[index] = None  # release the result once it has been used
+            yield index, result, error
+        if poll:
+            poll(len(futures))
+        finished = True
+    finally:
+        if not finished:
+            # cancelled (or the caller stopped early), so don't run the remaining jobs or wait for running jobs
+            for future in futures:
+                if future:
+                    future.cancel()
+        executor.shutdown(wait=finished)
@@ -0,0 +1,148 @@
+# Counters and timings of expensive operations (loading data files, exports, reliability, decoding video),
+# collected when profiling is turned on, e.g. by peyecoder-batch --profile
+
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+from peyecoder import version
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Profiler:
+    """Registry of the number of calls, durations and bytes processed by named operations.
+
+    Operations are measured with the profiled() decorator or the section() context manager.  Nothing is recorded
+    unless the profiler is enabled, so that the instrumentation costs almost nothing in normal use.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.durations = {}  # name: list of durations in seconds
+        self.bytes = {}  # name: total bytes
+        self.t0 = time.perf_counter()
+
+    def reset(self):
+        self.durations = {}
+        self.bytes = {}
+        self.t0 = time.perf_counter()
+
+    def record(self, name, seconds):
+        if self.enabled:
+            self.durations.setdefault(name, []).append(seconds)
+
+    def add_bytes(self, name, n):
+        if self.enabled:
+            self.bytes[name] = self.bytes.get(name, 0) + n
+
+    @contextmanager
+    def section(self, name):
+        """Measure the duration of a block of code"""
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def take(self):
+        """Return the measurements recorded so far and reset them, e.g. to send them from a worker process to be
+        merged into the measurements of the main process
+        """
+        measurements = (self.durations, self.bytes)
+        self.durations = {}
+        self.bytes = {}
+        return measurements
+
+    def merge(self, measurements):
+        """Add measurements returned by take()"""
+        durations, nbytes = measurements
+        for name, samples in durations.items():
+            self.durations.setdefault(name, []).extend(samples)
+        for name, n in nbytes.items():
+            self.bytes[name] = self.bytes.get(name, 0) + n
+
+    def summary(self):
+        """Summarize the measurements: {name: {'count', 'total_seconds', quantiles, 'max_seconds', 'bytes'}}"""
+        summary = {}
+        for name in sorted(set(self.durations) | set(self.bytes)):
+            samples = sorted(self.durations.get(name, ()))
+            s = {'count': len(samples), 'total_seconds': sum(samples)}
+            if samples:
+                for q in QUANTILES:
+                    s['p{:g}_seconds'.format(q * 100)] = samples[min(len(samples) - 1, int(q * len(samples)))]
+                s['max_seconds'] = samples[-1]
+            if name in self.bytes:
+                s['bytes'] = self.bytes[name]
+            summary[name] = s
+        return summary
+
+    def to_json(self):
+        return json.dumps({'peyecoder': version, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           'wall_seconds': time.perf_counter() - self.t0, 'operations': self.summary()}, indent=2)
+
+    def to_prometheus(self):
+        """Render the measurements in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = ['# HELP peyecoder_info peyecoder version',
+                 '# TYPE peyecoder_info gauge',
+                 'peyecoder_info{{version="{}"}} 1'.format(version),
+                 '# HELP peyecoder_wall_seconds Time since profiling started',
+                 '# TYPE peyecoder_wall_seconds gauge',
+                 'peyecoder_wall_seconds {:.6f}'.format(time.perf_counter() - self.t0),
+                 '# HELP peyecoder_duration_seconds Duration of operations',
+                 '# TYPE peyecoder_duration_seconds summary']
+        for name, s in summary.items():
+            if not s['count']:
+                continue
+            for q in QUANTILES:
+                lines.append('peyecoder_duration_seconds{{operation="{}",quantile="{:g}"}} {:.6f}'.format(
+                    name, q, s['p{:g}_seconds'.format(q * 100)]))
+            lines.append('peyecoder_duration_seconds_sum{{operation="{}"}} {:.6f}'.format(name, s['total_seconds']))
+            lines.append('peyecoder_duration_seconds_count{{operation="{}"}} {}'.format(name, s['count']))
+        lines += ['# HELP peyecoder_bytes_total Bytes processed by operations',
+                  '# TYPE peyecoder_bytes_total counter']
+        for name, s in summary.items():
+            if 'bytes' in s:
+                lines.append('peyecoder_bytes_total{{operation="{}"}} {}'.format(name, s['bytes']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Save the measurements as JSON if filename ends in .json, otherwise in the Prometheus text format"""
+        text = self.to_json() + '\n' if filename.lower().endswith('.json') else self.to_prometheus()
+        with open(filename, 'w') as f:
+            f.write(text)
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    """Decorator which records the duration of each call to a function as the operation name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.record(name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+def profiled_call(func, *args):
+    """Call func(*args) with profiling enabled, returning its result along with the measurements.
+    Used to run jobs in worker processes (which have their own profiler) and merge their measurements.  The duration
+    of the job is recorded as 'job.' followed by the name of func, so it doesn't add to an operation of the same name.
+    """
+    profiler.enabled = True
+    profiler.take()
+    with profiler.section('job.' + func.__name__):
+        result = func(*args)
+    return result, profiler.take()
@@ -1,9 +1,19 @@
 
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
 from peyecoder.models import Subject
-from dateutil import parser
+from peyecoder.profiling import profiled
 
 SHIFT_AGREEMENT_THRESHOLD = 1
 
+# Costs (in frames) used to align the responses of trials with different numbers of responses.  Matching two
+# responses costs the difference between their frames, plus RESPONSE_MISMATCH_COST if the responses differ.
+# Leaving a response unmatched costs UNMATCHED_COST, so responses more than 2 * UNMATCHED_COST frames apart are
+# never matched.
+RESPONSE_MISMATCH_COST = 15
+UNMATCHED_COST = 30
+
 
 def normalize_response(response):
     """ Transform response so that 'off' == 'away' """
@@ -13,27 +23,165 @@ def normalize_response(response):
         return response
 
 
+def overlapping_intervals(intervals1, intervals2):
+    """Generate (start frame, end frame, response 1, response 2) for each overlap between two lists of response
+    intervals (see Events.intervals).  Takes time proportional to the number of intervals.
+    """
+    j = 0
+    for start, end, response in intervals1:
+        # skip intervals which end before this interval, then report the overlapping intervals
+        while j < len(intervals2) and intervals2[j][1] <= start:
+            j += 1
+        k = j
+        while k < len(intervals2) and intervals2[k][0] < end:
+            start2, end2, response2 = intervals2[k]
+            yield max(start, start2), min(end, end2), response, response2
+            k += 1
+
+
 def compute_frame_agreement(s1, s2):
     """Compute percentage of frames with the same response, considering all (common) coded frames.
     'away' and 'off' responses are considered equivalent
+
+    The coding of each subject is a sequence of response intervals (see Events.intervals), so the intervals are
+    merged rather than comparing frame by frame, which takes time proportional to the number of events.
     """
-    s1_frames = s1.events.frames()
-    s2_frames = s2.events.frames()
+    intervals1 = s1.events.intervals()
+    intervals2 = s2.events.intervals()
 
-    total_frames = 0
+    # The intervals for each subject are contiguous, so the frames coded for s2 are a single range
+    if intervals2:
+        s2_start, s2_end = intervals2[0][0], intervals2[-1][1]
+    else:
+        s2_start, s2_end = 0, 0
+
+    total_frames = 0  # frames coded for both subjects
     same_frames = 0
-    for f, resp in s1_frames.items():
-        try:
-            resp2 = s2_frames[f]
-            total_frames += 1  # only increments if a frame is in both sets of frames
-        except KeyError:
-            resp2 = ''
-        if normalize_response(resp) == normalize_response(resp2):
-            same_frames += 1
+    for start, end, response in intervals1:
+        if normalize_response(response) == '':
+            # frames which are not coded for s2 are compared with an empty response
+            same_frames += (end - start) - max(0, min(end, s2_end) - max(start, s2_start))
+
+    for start, end, response1, response2 in overlapping_intervals(intervals1, intervals2):
+        total_frames += end - start
+        if normalize_response(response1) == normalize_response(response2):
+            same_frames += end - start
     pct_frame_agreement = same_frames / total_frames * 100 if total_frames else 0
     return pct_frame_agreement
 
 
+def frame_confusion(s1, s2):
+    """Count the frames coded for both subjects, by pairs of responses ('away' and 'off' are considered equivalent)
+    :return: Counter mapping (response 1, response 2) to a number of frames
+    """
+    confusion = Counter()
+    for start, end, response1, response2 in overlapping_intervals(s1.events.intervals(), s2.events.intervals()):
+        confusion[normalize_response(response1), normalize_response(response2)] += end - start
+    return confusion
+
+
+def cohens_kappa(confusion):
+    """Compute Cohen's kappa from a confusion matrix, as returned by frame_confusion.
+    Returns None if kappa is undefined (no frames, or both coders used only a single response).
+    """
+    total = sum(confusion.values())
+    if not total:
+        return None
+    totals1 = Counter()
+    totals2 = Counter()
+    for (response1, response2), n in confusion.items():
+        totals1[response1] += n
+        totals2[response2] += n
+    observed = sum(n for (response1, response2), n in confusion.items() if response1 == response2) / total
+    expected = sum(totals1[r] * totals2[r] for r in totals1) / total ** 2
+    if expected == 1:
+        return None
+    return (observed - expected) / (1 - expected)
+
+
+class DisagreementIndex:
+    """Ranges of frames in which two codings of a subject disagree, kept up to date while the first is edited.
+
+    The disagreements are a sorted list of (start frame, end frame) intervals (end frames are exclusive), covering
+    the frames coded for both subjects in which the responses differ ('away' and 'off' are considered equivalent).
+    The second coding is fixed, so its intervals are computed once; after an edit to the first coding, only the
+    disagreements near the edited frames are recomputed.
+    """
+    def __init__(self, s1, s2):
+        """
+        :param s1: Subject being edited
+        :param s2: Subject from a second coding session
+        """
+        self.s1 = s1
+        self.intervals2 = s2.events.intervals()
+        self.starts2 = [start for start, end, response in self.intervals2]
+        self.intervals = []
+        self.update()
+
+    def _disagreements(self, intervals1, start=None, end=None):
+        """Compute the disagreements with some of the intervals of the first coding, clipped to start...end"""
+        if start is not None:
+            # only the intervals of the second coding which overlap the range are needed
+            i = max(0, bisect_right(self.starts2, start) - 1)
+            intervals2 = self.intervals2[i:bisect_left(self.starts2, end)]
+            intervals1 = [(max(a, start), min(b, end), response) for a, b, response in intervals1]
+        else:
+            intervals2 = self.intervals2
+        return self._merge((a, b) for a, b, response1, response2 in overlapping_intervals(intervals1, intervals2)
+                           if normalize_response(response1) != normalize_response(response2))
+
+    def update(self, frames=None):
+        """Update the disagreements after the first coding has been edited
+        :param frames: Frame numbers of the events which were added, deleted or changed, or None to recompute all
+            disagreements
+        """
+        if frames is None:
+            self.intervals = self._disagreements(self.s1.events.intervals())
+            return
+        if not frames:
+            return
+
+        # The responses can only have changed from the event before the first edited frame up to the event after
+        # the last edited frame (or just after the last edited frame, if a final event was deleted)
+        events = self.s1.events
+        lo, hi = min(frames), max(frames)
+        i = events.bisect_frame(lo)
+        start = events[i - 1].frame if i > 0 else lo
+        i = events.bisect_frame(hi + 1)
+        end = max(events[i].frame, hi) + 1 if i < len(events) else hi + 1
+
+        new = self._disagreements(events.intervals(start, end), start, end)
+
+        # replace the disagreements within start...end, splitting any which extend beyond the range
+        i = bisect_left(self.intervals, (start,))
+        if i > 0 and self.intervals[i - 1][1] > start:
+            i -= 1
+        j = bisect_left(self.intervals, (end,))
+        if i < j and self.intervals[i][0] < start:
+            new.insert(0, (self.intervals[i][0], start))
+        if i < j and self.intervals[j - 1][1] > end:
+            new.append((end, self.intervals[j - 1][1]))
+        # rejoin disagreements which continue across the edges of the range
+        if i > 0 and new and self.intervals[i - 1][1] == new[0][0]:
+            i -= 1
+            new[0] = (self.intervals[i][0], new[0][1])
+        if j < len(self.intervals) and new and new[-1][1] == self.intervals[j][0]:
+            new[-1] = (new[-1][0], self.intervals[j][1])
+            j += 1
+        self.intervals[i:j] = self._merge(new)
+
+    @staticmethod
+    def _merge(intervals):
+        """Join adjacent intervals"""
+        merged = []
+        for a, b in intervals:
+            if merged and merged[-1][1] == a:
+                merged[-1] = (merged[-1][0], b)
+            else:
+                merged.append((a, b))
+        return merged
+
+
 def render_timecode(timecode, offsets, frame):
     """Render a timecode (e.g. 00:01:04.27)
     :param timecode: Timecode object (with predefined framerate, drop_frame)
@@ -61,6 +209,66 @@ def response_error(timecode, s1, s2, trial, frame_1, frame_2):
     return "Trial {}: Your response at {} is not similar to the other subject's response at {}.".format(trial, timecode_1, timecode_2)
 
 
+def unmatched_error(timecode, s, trial, frame, yours):
+    """Generate the error message for a response which does not match any response of the other subject"""
+    timecode_1 = render_timecode(timecode, s.timecode_offsets, frame)
+    if yours:
+        return "Trial {}: Your response at {} does not match any of the other subject's responses.".format(trial, timecode_1)
+    else:
+        return "Trial {}: The other subject's response at {} does not match any of your responses.".format(trial, timecode_1)
+
+
+def align_events(t1, t2):
+    """Match up the events of two codings of a trial which have different numbers of events.
+    The first and last events of the trials are always matched.  The other events are aligned by dynamic programming
+    to minimise the total cost of matched and unmatched events (see RESPONSE_MISMATCH_COST and UNMATCHED_COST).
+    :return: list of (index in t1, index in t2) pairs in order, with None for an event which is not matched
+    """
+    import numpy as np
+
+    n, m = len(t1), len(t2)
+    if n == 1 or m == 1:
+        # a single event is both the first and the last event of its trial
+        return [(0, 0)] + [(i, None) for i in range(1, n)] + [(None, j) for j in range(1, m)]
+
+    # interior events of each trial
+    frames1 = np.array([e.frame for e in t1[1:n - 1]], dtype=np.int64)
+    frames2 = np.array([e.frame for e in t2[1:m - 1]], dtype=np.int64)
+    responses1 = [normalize_response(e.response) for e in t1[1:n - 1]]
+    responses2 = np.array([normalize_response(e.response) for e in t2[1:m - 1]], dtype=object)
+
+    def match_costs(i):
+        """Costs of matching interior event i of t1 to each interior event of t2"""
+        return np.abs(frames2 - frames1[i]) + RESPONSE_MISMATCH_COST * (responses2 != responses1[i])
+
+    # cost[i, j] is the cost of aligning the first i interior events of t1 with the first j interior events of t2.
+    # Each row is computed with array operations: the dependence of each cell on the cell to its left is a running
+    # minimum, cost[i, j] = min over k <= j of (best[k] + (j - k) * UNMATCHED_COST).
+    steps = np.arange(len(frames2) + 1) * UNMATCHED_COST
+    cost = np.empty((len(frames1) + 1, len(frames2) + 1), dtype=np.int64)
+    cost[0] = steps
+    for i in range(len(frames1)):
+        best = cost[i] + UNMATCHED_COST
+        best[1:] = np.minimum(best[1:], cost[i, :-1] + match_costs(i))
+        cost[i + 1] = steps + np.minimum.accumulate(best - steps)
+
+    # trace back through the cost matrix to recover the alignment
+    # (indices of interior events are 1 more than indices into frames1 and frames2, which matches t1 and t2)
+    pairs = []
+    i, j = len(frames1), len(frames2)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and cost[i, j] == cost[i - 1, j - 1] + match_costs(i - 1)[j - 1]:
+            pairs.append((i, j))
+            i, j = i - 1, j - 1
+        elif i > 0 and cost[i, j] == cost[i - 1, j] + UNMATCHED_COST:
+            pairs.append((i, None))
+            i -= 1
+        else:
+            pairs.append((None, j))
+            j -= 1
+    return [(0, 0)] + pairs[::-1] + [(n - 1, m - 1)]
+
+
 def reliability_report(s1: Subject, s2: Subject, timecode):
     """Create a reliability report
     :param s1: Subject object containing "your" coding
@@ -68,12 +276,25 @@ def reliability_report(s1: Subject, s2: Subject, timecode):
     :param timecode: Timecode object used to render timecodes from frame numbers
     :return: Reliability report as an array of strings
     """
+    report, stats = reliability_stats(s1, s2, timecode)
+    return report
+
+
+@profiled('reliability')
+def reliability_stats(s1: Subject, s2: Subject, timecode):
+    """Create a reliability report, and also return the summary statistics
+    :param s1: Subject object containing "your" coding
+    :param s2: Subject object containing "other" coding
+    :param timecode: Timecode object used to render timecodes from frame numbers
+    :return: Reliability report as an array of strings, and a dictionary of agreement percentages (empty if the
+    subjects cannot be compared)
+    """
     report = []
 
     # make sure subjects are the same:
     if not subjects_are_comparable(s1, s2):
         report.append('Subject number, birthdate, date of test, and order must all match. Cannot compare the subjects.')
-        return report
+        return report, {}
 
     s1_trials = s1.events.trials()
     s2_trials = s2.events.trials()
@@ -95,6 +316,8 @@ def reliability_report(s1: Subject, s2: Subject, timecode):
     # Shift Agreement
     total_shifts = 0
     same_shifts = 0
+    unmatched_1 = 0  # responses in your coding with no match in the other coding (deletions)
+    unmatched_2 = 0  # responses in the other coding with no match in your coding (insertions)
 
     comparable = 0
     for t in common_trials:
@@ -102,44 +325,55 @@ def reliability_report(s1: Subject, s2: Subject, timecode):
         t2 = s2_trials[t]
         if len(t1) == len(t2):
             comparable += 1
-            # Trials are comparable, so compute
-
-            for i in range(len(t1)):
-                if i in (0, len(t1) - 1):
-                    # This is a fixed event.  Do not compare for shift agreement, but still must be identical.
-                    # check for time stamp agreement: frame must be identical
-                    difference = t1[i].frame - t2[i].frame
-                    if difference:
-                        report.append(timing_error(timecode, s1, s2, t, t1[i].frame, t2[i].frame))
-                    # check for response agreement
-                    if normalize_response(t1[i].response) != normalize_response(t2[i].response):
-                        report.append(response_error(timecode, s1, s2, t, t1[i].frame, t2[i].frame))
+            # Trials are comparable, so compare responses in order
+            pairs = [(i, i) for i in range(len(t1))]
+        else:
+            report.append(('Trial {}: Your subject had {} responses, while the other subject had {} responses.'
+                           ' Responses were matched by timing and response.').format(t, len(t1), len(t2)))
+            pairs = align_events(t1, t2)
+
+        for i, j in pairs:
+            if j is None or i is None:
+                # Unmatched responses are counted as shifts which do not agree
+                total_shifts += 1
+                if j is None:
+                    unmatched_1 += 1
+                    report.append(unmatched_error(timecode, s1, t, t1[i].frame, yours=True))
                 else:
-                    # not a fixed event.
-                    if normalize_response(t1[i].response) == normalize_response(t2[i].response):
-                        if t1[i].response == 'away':
-                            pass
-                        elif t1[i].response == 'off' and t1[i-1].response == 'away':
-                            pass
-                        else:
-                            total_shifts += 1
-                            if abs(t1[i].frame - t2[i].frame) <= SHIFT_AGREEMENT_THRESHOLD:
-                                same_shifts += 1
-                            else:
-                                report.append(timing_error(timecode, s1, s2, t, t1[i].frame, t2[i].frame))
+                    unmatched_2 += 1
+                    report.append(unmatched_error(timecode, s2, t, t2[j].frame, yours=False))
+            elif i in (0, len(t1) - 1):
+                # This is a fixed event.  Do not compare for shift agreement, but still must be identical.
+                # check for time stamp agreement: frame must be identical
+                difference = t1[i].frame - t2[j].frame
+                if difference:
+                    report.append(timing_error(timecode, s1, s2, t, t1[i].frame, t2[j].frame))
+                # check for response agreement
+                if normalize_response(t1[i].response) != normalize_response(t2[j].response):
+                    report.append(response_error(timecode, s1, s2, t, t1[i].frame, t2[j].frame))
+            else:
+                # not a fixed event.
+                if normalize_response(t1[i].response) == normalize_response(t2[j].response):
+                    if t1[i].response == 'away':
+                        pass
+                    elif t1[i].response == 'off' and t1[i-1].response == 'away':
+                        pass
                     else:
                         total_shifts += 1
-                        # response error
-                        report.append(response_error(timecode, s1, s2, t, t1[i].frame, t2[i].frame))
-
-                        if abs(t1[i].frame - t2[i].frame) <= SHIFT_AGREEMENT_THRESHOLD:
+                        if abs(t1[i].frame - t2[j].frame) <= SHIFT_AGREEMENT_THRESHOLD:
                             same_shifts += 1
                         else:
-                            # timing error
-                            report.append(timing_error(timecode, s1, s2, t, t1[i].frame, t2[i].frame))
-        else:
-            report.append(('Trial {}: Your subject had {} responses, while the other subject had {} responses.'
-                           ' Cannot compare this trial.').format(t, len(t1), len(t2)))
+                            report.append(timing_error(timecode, s1, s2, t, t1[i].frame, t2[j].frame))
+                else:
+                    total_shifts += 1
+                    # response error
+                    report.append(response_error(timecode, s1, s2, t, t1[i].frame, t2[j].frame))
+
+                    if abs(t1[i].frame - t2[j].frame) <= SHIFT_AGREEMENT_THRESHOLD:
+                        same_shifts += 1
+                    else:
+                        # timing error
+                        report.append(timing_error(timecode, s1, s2, t, t1[i].frame, t2[j].frame))
 
     pct_comparable = comparable / len(common_trials) * 100 if common_trials else 0
     pct_shift_agreement = same_shifts / total_shifts * 100 if total_shifts else 0
@@ -150,26 +384,31 @@ def reliability_report(s1: Subject, s2: Subject, timecode):
     report.append('Frame agreement: {:.2f}%'.format(pct_frame_agreement))
     report.append('Comparable trials: {:.2f}%'.format(pct_comparable))
     report.append('Shift agreement: {:.2f}%'.format(pct_shift_agreement))
-    return report
-
-
-def str2date(datestr):
-    """Use dateutil.parser to convert a string to a date"""
-    return parser.parse(datestr, dayfirst=False).date()
+    report.append('Unmatched responses: {} of yours, {} of the other subject'.format(unmatched_1, unmatched_2))
+    stats = {
+        'Frame agreement': pct_frame_agreement,
+        'Comparable trials': pct_comparable,
+        'Shift agreement': pct_shift_agreement,
+        'Deletions': unmatched_1,
+        'Insertions': unmatched_2
+    }
+    return report, stats
+
+
+def comparability_key(s: Subject):
+    """Values which must match for two subjects to be compared.  Subjects with equal keys are comparable.
+    Returns None if the birthday or date of test can't be parsed, since the subject can't be compared.
+    """
+    try:
+        return str(s['Number']), str(s['Order']), s.date('Birthday'), s.date('Date of Test')
+    except ValueError:
+        return None
 
 
 def subjects_are_comparable(s1: Subject, s2: Subject):
     """ Return true if subjects can be compared"""
-    date_fields = ('Birthday', 'Date of Test')
-    fields = ('Number', 'Order')
-    comparable = all([str(s1[f]) == str(s2[f]) for f in fields]) and \
-        all([str2date(s1[f]) == str2date(s2[f]) for f in date_fields])
-
-    return comparable
-
-
-
-
-
-
-
+    # compare the number and order first, so that dates are only parsed for subjects which may match
+    if (str(s1['Number']), str(s1['Order'])) != (str(s2['Number']), str(s2['Order'])):
+        return False
+    key = comparability_key(s1)
+    return key is not None and key == comparability_key(s2)
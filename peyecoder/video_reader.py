@@ -1,6 +1,8 @@
 import cv2
 from collections import deque
 
+from peyecoder.profiling import profiler, profiled
+
 
 class VideoReader:
     def __init__(self, video_source=0):
@@ -15,11 +17,14 @@ class VideoReader:
         self.height = self.vid.get(cv2.CAP_PROP_FRAME_HEIGHT)
         self.frame_count = self.vid.get(cv2.CAP_PROP_FRAME_COUNT)
         self.frame_rate = self.vid.get(cv2.CAP_PROP_FPS)
+        self.fourcc = int(self.vid.get(cv2.CAP_PROP_FOURCC)).to_bytes(4, 'little').decode('ascii', 'replace')
 
+    @profiled('decode')
     def get_frame(self):
         if self.vid.isOpened():
             ret, frame = self.vid.read()
             if ret:
+                profiler.add_bytes('decode', frame.nbytes)
                 # Return a boolean success flag and the current frame converted to RGB from BGR
                 return ret, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             else:
@@ -27,6 +32,7 @@ class VideoReader:
         else:
             return False, None
 
+    @profiled('seek')
     def seek(self, frame_number):
         # seek to a specific frame in the video
         self.vid.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
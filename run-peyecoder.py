@@ -1,3 +1,4 @@
+import multiprocessing
 import peyecoder.gui
 import sys
 
@@ -5,5 +6,6 @@ import sys
 import _tkinter
 
 if __name__ == "__main__":
+    # Needed by frozen (e.g., PyInstaller) builds, in which worker processes are started by running the executable
+    multiprocessing.freeze_support()
     peyecoder.gui.run(sys.argv)
-
@@ -17,6 +17,9 @@ setuptools.setup(
     entry_points={
         'gui_scripts': [
             "peyecoder-gui = peyecoder.gui:run",
+        ],
+        'console_scripts': [
+            "peyecoder-batch = peyecoder.batch:main",
         ]
     },
     classifiers=[
@@ -35,5 +38,9 @@ setuptools.setup(
         'python-dateutil',
         'sortedcontainers',
         'timecode'
-    ]
+    ],
+    extras_require={
+        # Parquet and Feather export
+        'columnar': ['pyarrow'],
+    }
 )
\ No newline at end of file